@@ -0,0 +1,225 @@
+""" Tests of fynesse.access which run without a database server or network access """
+
+import os
+import re
+import shutil
+import tempfile
+import threading
+import unittest
+
+import pandas as pd
+
+from fynesse import access
+
+
+class StubOverpass:
+    """ A local stand-in for the Overpass client, answering queries from a fixed list of features
+        It records the bounds of each query, so the tests can check which areas were fetched
+    :param features: the GeoJSON features, each with a "tag" property holding its key=value tag
+    """
+
+    def __init__(self, features):
+        self.features = features
+        self.queries = []
+
+    def Get(self, query):
+        (minx, miny, maxx, maxy) = (float(x) for x in re.search(r"\(([^(),]+),([^(),]+),([^(),]+),([^()]+)\)",
+                                                                 query).groups())
+        self.queries.append((minx, miny, maxx, maxy))
+        tags = set(re.findall(r'\["([^"]+)"="([^"]+)"\]', query))
+        features = []
+        for feature in self.features:
+            if tuple(feature["properties"]["tag"].split("=")) not in tags:
+                continue
+            if feature["geometry"] is not None:
+                (lon, lat) = feature["geometry"]["coordinates"]
+                if not (minx <= lat <= maxx and miny <= lon <= maxy):
+                    continue
+            features.append(feature)
+        return {"features": features}
+
+
+def point(id, lat, lon, tag):
+    """ Returns a GeoJSON node feature with a tag """
+    return {"type": "Feature", "id": id, "geometry": {"type": "Point", "coordinates": [lon, lat]},
+            "properties": {"tag": tag}}
+
+
+class PoisCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = access.PoisCache(os.path.join(self.directory, "pois_cache"), tile_size=0.25)
+        self.api = StubOverpass([
+            point(1, 53.1, 0.1, "amenity=school"),
+            point(2, 53.6, 0.6, "amenity=school"),
+            point(3, 52.4, -0.9, "amenity=school"),
+            point(4, 53.1, 0.1, "amenity=pub"),
+            {"type": "Feature", "id": 5, "geometry": None, "properties": {"tag": "amenity=school"}},
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_hit_does_not_query(self):
+        first = access.get_pois(bbox=(53.1, 0.1, 0.1), tags={"amenity": "school"}, cache=self.cache, api=self.api)
+        queries = len(self.api.queries)
+        second = access.get_pois(bbox=(53.1, 0.1, 0.1), tags={"amenity": "school"}, cache=self.cache, api=self.api)
+        self.assertGreater(queries, 0)
+        self.assertEqual(len(self.api.queries), queries)
+        self.assertEqual(len(first.index), 1)
+        self.assertEqual(len(second.index), 1)
+
+    def test_miss_only_fetches_missing_tiles(self):
+        access.get_pois(bbox=(53.125, 0.125, 0.125), tags={"amenity": "school"}, cache=self.cache, api=self.api)
+        self.api.queries.clear()
+        access.get_pois(bbox=(53.125, 0.125, 1.0), tags={"amenity": "school"}, cache=self.cache, api=self.api)
+        cached = self.cache.tile_bounds((212, 0))
+        self.assertGreater(len(self.api.queries), 0)
+        for bounds in self.api.queries:
+            self.assertFalse(bounds[0] < cached[2] and cached[0] < bounds[2]
+                             and bounds[1] < cached[3] and cached[1] < bounds[3])
+
+    def test_rectangles_cover_the_tiles(self):
+        tiles = [(0, 0), (0, 1), (1, 0), (1, 1), (2, 1), (0, 3)]
+        rectangles = access.PoisCache.rectangles(tiles)
+        self.assertEqual(sorted(tile for rectangle in rectangles for tile in rectangle), sorted(tiles))
+        self.assertIn([(0, 0), (0, 1), (1, 0), (1, 1)], rectangles)
+
+    def test_offline(self):
+        with self.assertRaises(ValueError):
+            access.get_pois(bbox=(53.1, 0.1, 0.1), tags={"amenity": "school"}, offline=True, api=self.api)
+        pois = access.get_pois(bbox=(53.1, 0.1, 0.1), tags={"amenity": "school"}, cache=self.cache,
+                               offline=True, api=self.api)
+        self.assertEqual(len(pois.index), 0)
+        self.assertEqual(self.api.queries, [])
+
+        access.get_pois(bbox=(53.1, 0.1, 0.1), tags={"amenity": "school"}, cache=self.cache, api=self.api)
+        pois = access.get_pois(bbox=(53.1, 0.1, 0.1), tags={"amenity": "school"}, cache=self.cache,
+                               offline=True, api=StubOverpass([]))
+        self.assertEqual(len(pois.index), 1)
+
+    def test_cached_and_uncached_match(self):
+        for bbox in [(53.1, 0.1, 1.0), (53.0, 0.0, 0.6), (52.5, -0.5, 0.5)]:
+            tags = {"amenity": "school"}
+            uncached = access.get_pois(bbox=bbox, tags=tags, api=self.api)
+            cached = access.get_pois(bbox=bbox, tags=tags, cache=self.cache, api=self.api)
+            self.assertEqual(sorted(uncached.geometry.to_wkt()), sorted(cached.geometry.to_wkt()))
+            self.assertTrue(all(uncached["tag"] == "amenity=school"))
+
+
+class StubConnection:
+    """ A stand-in for a Connection which records the files loaded by LOAD DATA, without a database server
+    :param fail: the file whose LOAD DATA raises an error
+    """
+
+    dialect = "mariadb"
+
+    def __init__(self, fail=None):
+        self.fail = fail
+        self.loaded = []
+
+    def query(self, query):
+        match = re.search(r"LOAD DATA LOCAL INFILE '([^']+)' INTO TABLE pp_data", query)
+        if match:
+            filename = match.group(1)
+            assert os.path.exists(filename), f"{filename} is loaded before it is downloaded"
+            if filename == self.fail:
+                raise RuntimeError(f"Error loading {filename}")
+            self.loaded.append(filename)
+        # An empty result, so has_table finds no table
+        return pd.DataFrame({"table_name": [], "n": []})
+
+
+class LoadDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.chdir(self.directory)
+        os.makedirs("source")
+        self.filenames = [f"pp-{year}-part{part}.csv" for year in range(2000, 2004) for part in range(1, 3)]
+        for filename in self.filenames:
+            with open(os.path.join("source", filename), "w") as source_file:
+                source_file.write(f"{filename}\n")
+
+        self.downloaded = []
+        self.most_prefetched = 0
+        copy = access.directory_source("source")
+
+        def source(filename, destination):
+            copy(filename, destination)
+            self.downloaded.append(filename)
+            self.most_prefetched = max(self.most_prefetched, len(self.leftover_files()))
+
+        self.source = source
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def leftover_files():
+        return [filename for filename in os.listdir(".") if filename.endswith(".csv")]
+
+    def load(self, connections, **options):
+        """ Runs load_data in a thread, failing the test if it does not finish (e.g. a deadlock) """
+        table = access.PPDataTable(connections[0], manifest="manifest.json")
+        result = {}
+
+        def run():
+            try:
+                table.load_data(start_year=2000, end_year=2003, source=self.source, connections=connections,
+                                **options)
+            except BaseException as e:
+                result["error"] = e
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(timeout=30)
+        self.assertFalse(thread.is_alive(), "load_data did not finish")
+        return table, result.get("error")
+
+    def test_loads_every_file_once(self):
+        connections = [StubConnection(), StubConnection()]
+        table, error = self.load(connections)
+        self.assertIsNone(error)
+        loaded = connections[0].loaded + connections[1].loaded
+        self.assertEqual(sorted(loaded), sorted(self.filenames))
+        self.assertEqual(table.loaded_parts(), set(self.filenames))
+        self.assertEqual(self.leftover_files(), [])
+
+    def test_prefetch_smaller_than_download_workers(self):
+        connections = [StubConnection(), StubConnection()]
+        _, error = self.load(connections, download_workers=4, prefetch=1)
+        self.assertIsNone(error)
+        self.assertEqual(sorted(connections[0].loaded + connections[1].loaded), sorted(self.filenames))
+        self.assertLessEqual(self.most_prefetched, 1)
+
+    def test_resume_after_failure(self):
+        failing = StubConnection(fail="pp-2001-part2.csv")
+        table, error = self.load([failing])
+        self.assertIsInstance(error, RuntimeError)
+        self.assertEqual(failing.loaded, self.filenames[:3])
+        self.assertEqual(table.loaded_parts(), set(self.filenames[:3]))
+        self.assertEqual(self.leftover_files(), [])
+
+        resumed = StubConnection()
+        self.downloaded.clear()
+        table, error = self.load([resumed])
+        self.assertIsNone(error)
+        self.assertEqual(resumed.loaded, self.filenames[3:])
+        self.assertEqual(sorted(self.downloaded), sorted(self.filenames[3:]))
+        self.assertEqual(table.loaded_parts(), set(self.filenames))
+
+    def test_files_removed_after_error(self):
+        connections = [StubConnection(fail="pp-2000-part2.csv"), StubConnection(fail="pp-2000-part2.csv")]
+        _, error = self.load(connections, download_workers=4, prefetch=4)
+        self.assertIsInstance(error, RuntimeError)
+        self.assertEqual(self.leftover_files(), [])
+        self.assertNotIn("pp-2000-part2.csv", access.PPDataTable(connections[0], manifest="manifest.json")
+                         .loaded_parts())
+
+
+if __name__ == "__main__":
+    unittest.main()
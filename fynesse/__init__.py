@@ -1,3 +1,4 @@
 from . import access
 from . import assess
 from . import address
+from . import benchmark
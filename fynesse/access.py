@@ -5,6 +5,18 @@ Beyond the legal side also think about the ethical issues around this data.
 """
 
 import os
+import json
+import queue
+import shutil
+import threading
+import time
+import hashlib
+import tempfile
+import weakref
+import functools
+from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 import yaml
 from ipywidgets import interact_manual, Text, Password
 import pymysql
@@ -14,8 +26,14 @@ import pandas as pd
 import shapely
 import geopandas
 import overpass
-from datetime import datetime
 import math
+import re
+import random
+
+PP_DATA_URL = "http://prod.publicdata.landregistry.gov.uk.s3-website-eu-west-1.amazonaws.com/"
+
+# The rows of prices_coordinates are assigned to this many random buckets, used for sampling
+SAMPLE_BUCKETS = 10000
 
 
 def test_table_creation(connection, table):
@@ -28,6 +46,30 @@ def test_table_creation(connection, table):
     print("The table was created successfully")
 
 
+def url_source(base_url):
+    """ Returns a source downloading files relative to a base url
+        The source is a function (filename, destination) used by the table loaders
+    :param base_url: the url the filenames are appended to
+    """
+
+    def fetch(filename, destination):
+        request.urlretrieve(f"{base_url}{filename}", destination)
+
+    return fetch
+
+
+def directory_source(directory):
+    """ Returns a source copying files from a local directory
+        Useful to test the loaders, or to load files that were already downloaded
+    :param directory: the directory containing the files
+    """
+
+    def fetch(filename, destination):
+        shutil.copyfile(os.path.join(directory, filename), destination)
+
+    return fetch
+
+
 def credentials_interact():
     """ Create an interactive prompt for the sql username and password """
 
@@ -47,6 +89,202 @@ def credentials_interact():
                     password=Password(description="Password:"))
 
 
+class QueryMetrics:
+    """ Timings of the queries run by a connection, split into the execute, fetch and materialize phases
+        Queries slower than explain_threshold also get their EXPLAIN (or ANALYZE) plan recorded.
+        A hook, if given, is called with each record, e.g. to send it to a monitoring system.
+    :param explain_threshold: the seconds above which the plan of a SELECT query is captured (None never does)
+    :param analyze: if true, the plan is captured with ANALYZE (which runs the query again) instead of EXPLAIN
+    :param hook: a function called with the dict recorded for each query
+    :param max_records: the number of most recent queries kept
+    """
+
+    def __init__(self, *, explain_threshold=None, analyze=False, hook=None, max_records=10000):
+        self.explain_threshold = explain_threshold
+        self.analyze = analyze
+        self.hook = hook
+        self.records = deque(maxlen=max_records)
+        self.loads = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @staticmethod
+    def template(query):
+        """ Returns the query with its literals replaced by ?, so the runs of the same query are grouped
+        :param query: the string of the query
+        """
+        query = re.sub(r"'[^']*'|\"[^\"]*\"", "?", query)
+        query = re.sub(r"\b\d+(\.\d+)?\b", "?", query)
+        return " ".join(query.split())[:200]
+
+    def should_explain(self, query, seconds):
+        """ Returns True if the plan of the query should be captured
+        :param query: the string of the query
+        :param seconds: the time taken by the query
+        """
+        return (self.explain_threshold is not None and seconds >= self.explain_threshold
+                and re.match(r"\s*SELECT\b", query, re.IGNORECASE) is not None
+                and ";" not in query.strip().rstrip(";"))
+
+    def record(self, query, *, execute, fetch, materialize, rows, size, plan=None):
+        """ Records the timings of a query and returns the record
+        :param query: the string of the query
+        :param execute: the seconds taken to execute the query
+        :param fetch: the seconds taken to fetch the rows
+        :param materialize: the seconds taken to build the DataFrame
+        :param rows: the number of rows returned (or affected)
+        :param size: the bytes of the DataFrame returned
+        :param plan: the plan of the query, if captured
+        """
+        entry = {
+            "query": self.template(query),
+            "execute": execute,
+            "fetch": fetch,
+            "materialize": materialize,
+            "total": execute + fetch + materialize,
+            "rows": rows,
+            "bytes": size,
+            "plan": plan,
+        }
+        with self.lock:
+            self.records.append(entry)
+        self.local.last = entry
+        if self.hook is not None:
+            self.hook(entry)
+        return entry
+
+    def last(self):
+        """ Returns the record of the last query run by the current thread """
+        return getattr(self.local, "last", None)
+
+    def record_load(self, filename, *, rows, seconds):
+        """ Records the loading of a file into a table
+        :param filename: the file loaded
+        :param rows: the number of rows loaded
+        :param seconds: the seconds taken by the load
+        """
+        with self.lock:
+            self.loads.append({"file": filename, "rows": rows, "seconds": seconds,
+                               "rows_per_second": rows / seconds if seconds else None})
+
+    def summary(self):
+        """ Returns a DataFrame with the number of runs, the timings and the sizes of each query, slowest first """
+        with self.lock:
+            records = pd.DataFrame(list(self.records))
+        if len(records.index) == 0:
+            return records
+        return records.groupby("query").agg(
+            runs=("total", "size"),
+            total=("total", "sum"),
+            execute=("execute", "sum"),
+            fetch=("fetch", "sum"),
+            materialize=("materialize", "sum"),
+            rows=("rows", "sum"),
+            bytes=("bytes", "sum"),
+        ).sort_values("total", ascending=False)
+
+    def slow_queries(self):
+        """ Returns a DataFrame with the queries whose plan was captured """
+        with self.lock:
+            records = pd.DataFrame([record for record in self.records if record["plan"] is not None])
+        return records
+
+    def load_summary(self):
+        """ Returns a DataFrame with the throughput of each file loaded """
+        with self.lock:
+            return pd.DataFrame(self.loads)
+
+
+def timed_query(connection, query, metrics):
+    """ Performs a query on a pymysql connection, recording its timings
+        The result is the one of the first statement of the query, but all of them are run before returning.
+    :param connection: the pymysql connection
+    :param query: the string of the MariaDB query
+    :param metrics: the QueryMetrics recording the timings (None does not record them)
+    """
+    start = time.perf_counter()
+    cursor = connection.cursor()
+    cursor.execute(query)
+    executed = time.perf_counter()
+    rows = cursor.fetchall()
+    columns = [x for x, *_ in cursor.description] if cursor.description else []
+    rowcount = len(rows) if cursor.description else cursor.rowcount
+    # Read the results of the other statements, so an error in any of them is raised here
+    while cursor.nextset():
+        pass
+    fetched = time.perf_counter()
+    result = pd.DataFrame(rows, columns=columns)
+    materialized = time.perf_counter()
+
+    if metrics is not None:
+        plan = None
+        if metrics.should_explain(query, materialized - start):
+            cursor.execute(f"{'ANALYZE' if metrics.analyze else 'EXPLAIN'} {query}")
+            plan = pd.DataFrame(cursor.fetchall(), columns=[x for x, *_ in cursor.description])
+        metrics.record(query,
+                       execute=executed - start, fetch=fetched - executed, materialize=materialized - fetched,
+                       rows=rowcount,
+                       size=int(result.memory_usage(index=False, deep=True).sum()), plan=plan)
+    return result
+
+
+def timed_chunks(cursor, query, metrics, *, chunksize, statement=None):
+    """ Performs a query on a cursor, yielding the result as DataFrames of at most chunksize rows
+        The timings are recorded once the chunks are consumed (or the generator is closed),
+        with the fetch and materialize times, rows and bytes summed over the chunks
+    :param cursor: the cursor running the query
+    :param query: the string of the query
+    :param metrics: the QueryMetrics recording the timings (None does not record them)
+    :param chunksize: the maximum number of rows in each DataFrame
+    :param statement: the statement executed, if it is not the query itself (e.g. the translated query)
+    """
+    start = time.perf_counter()
+    cursor.execute(query if statement is None else statement)
+    executed = time.perf_counter()
+
+    fetch = materialize = 0.0
+    rows = size = 0
+    try:
+        columns = [x for x, *_ in cursor.description] if cursor.description else []
+        while True:
+            before = time.perf_counter()
+            chunk = cursor.fetchmany(chunksize)
+            fetched = time.perf_counter()
+            fetch += fetched - before
+            if not chunk:
+                break
+            result = pd.DataFrame(chunk, columns=columns)
+            materialize += time.perf_counter() - fetched
+            rows += len(chunk)
+            size += int(result.memory_usage(index=False, deep=True).sum())
+            yield result
+    finally:
+        if metrics is not None:
+            metrics.record(query, execute=executed - start, fetch=fetch, materialize=materialize,
+                           rows=rows, size=size)
+
+
+def timed_transaction(connection, statements, metrics):
+    """ Performs statements in a single transaction on a pymysql connection, recording their timings
+        Each statement is its own query, so an error in any of them is raised before the transaction
+        commits, and the transaction is then rolled back.
+    :param connection: the pymysql connection
+    :param statements: the list of strings of the MariaDB statements
+    :param metrics: the QueryMetrics recording the timings (None does not record them)
+    """
+    timed_query(connection, "START TRANSACTION;", metrics)
+    try:
+        for statement in statements:
+            timed_query(connection, statement, metrics)
+        timed_query(connection, "COMMIT;", metrics)
+    except Exception:
+        try:
+            connection.rollback()
+        except pymysql.err.Error:
+            pass
+        raise
+
+
 class Connection:
     """ A database connection to the MariaDB database
         specified by the host url and database name.
@@ -54,14 +292,19 @@ class Connection:
     :param password: password
     :param host: host url
     :param port: port number
+    :param metrics: the QueryMetrics recording the timings of the queries (by default a new one)
     """
 
-    def __init__(self, *, username, password, host, port):
+    # The SQL dialect of the queries, used by the functions of this module to pick what the database supports
+    dialect = "mariadb"
+
+    def __init__(self, *, username, password, host, port, metrics=None):
         self.username = username
         self.password = password
         self.host = host
         self.port = port
         self.connection = None
+        self.metrics = QueryMetrics() if metrics is None else metrics
 
         try:
             self.connection = pymysql.connect(
@@ -102,24 +345,338 @@ class Connection:
         """ Perform a query on this databases
         :param query: the string of the MariaDB query
         """
-        cursor = self.connection.cursor()
-        cursor.execute(query)
-        rows = cursor.fetchall()
-        columns = [x for x, *_ in cursor.description] if cursor.description else []
-        return pd.DataFrame(rows, columns=columns)
+        return timed_query(self.connection, query, self.metrics)
+
+    def transaction(self, statements):
+        """ Perform statements in a single transaction, rolled back if any of them fails
+        :param statements: the list of strings of the MariaDB statements
+        """
+        timed_transaction(self.connection, statements, self.metrics)
+
+    def query_chunks(self, query, *, chunksize=100000):
+        """ Perform a query on this database, yielding the result as DataFrames of at most chunksize rows
+            An unbuffered cursor streams the rows from the server, so memory does not grow with the result.
+            The generator must be consumed (or closed) before another query runs on this connection.
+        :param query: the string of the MariaDB query
+        :param chunksize: the maximum number of rows in each DataFrame
+        """
+        cursor = self.connection.cursor(pymysql.cursors.SSCursor)
+        try:
+            yield from timed_chunks(cursor, query, self.metrics, chunksize=chunksize)
+        finally:
+            cursor.close()
+
+
+class ConnectionPool:
+    """ A thread-safe pool of connections to the MariaDB database
+        It has the same query interface as Connection, so it can be used in its place.
+        Each query borrows a connection, checking it is still alive and reconnecting if it is not.
+    :param username: username
+    :param password: password
+    :param host: host url
+    :param port: port number
+    :param database: the database used by the connections
+    :param size: the maximum number of open connections
+    :param timeout: the maximum seconds waited for a free connection (None waits forever)
+    :param health_check_interval: the seconds a connection can be idle before it is checked again
+    :param metrics: the QueryMetrics recording the timings of the queries (by default a new one)
+    """
+
+    dialect = "mariadb"
+
+    # The session variables of every connection, set when it is opened (see set_session)
+    session = {"sql_mode": "'NO_AUTO_VALUE_ON_ZERO'", "time_zone": "'+00:00'"}
+
+    def __init__(self, *, username, password, host, port, database=None, size=4, timeout=None,
+                 health_check_interval=30, metrics=None):
+        self.username = username
+        self.password = password
+        self.host = host
+        self.port = port
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.metrics = QueryMetrics() if metrics is None else metrics
+        self.session = dict(self.session)
+
+        self.free = queue.LifoQueue()
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def session_command(self):
+        """ Returns the statement setting the session variables """
+        return "SET " + ", ".join(f"{name} = {value}" for name, value in self.session.items())
+
+    def connect(self):
+        """ Opens a new connection to the server
+            The connections autocommit, so an idle connection in the pool never keeps a transaction open
+            (with its snapshot and its locks), and the session variables are set on each of them.
+        """
+        return pymysql.connect(
+            user=self.username,
+            passwd=self.password,
+            host=self.host,
+            port=self.port,
+            local_infile=1,
+            db=self.database,
+            autocommit=True,
+            init_command=self.session_command(),
+            client_flag=pymysql.constants.CLIENT.MULTI_STATEMENTS
+        )
+
+    def set_session(self, **variables):
+        """ Sets session variables on all the connections of the pool, including the ones opened later
+            (e.g. set_session(unique_checks=0))
+        :param variables: the values of the variables, as SQL literals
+        """
+        with self.lock:
+            self.session.update({name: str(value) for name, value in variables.items()})
+
+    def acquire(self):
+        """ Borrows a healthy connection from the pool, opening one if the pool is not full
+            Returns the pool entry, whose "connection" is the pymysql connection
+        """
+        start = time.perf_counter()
+
+        entry = None
+        try:
+            entry = self.free.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                if len(self.entries) < self.size:
+                    entry = {"connection": None, "database": self.database, "session": None, "last_used": 0.0,
+                             "acquisitions": 0, "queries": 0, "reconnects": 0,
+                             "total_wait": 0.0, "max_wait": 0.0}
+                    self.entries.append(entry)
+            if entry is None:
+                try:
+                    entry = self.free.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"No free connection in the pool after {self.timeout} seconds")
+
+        try:
+            self.check(entry)
+        except Exception:
+            self.release(entry)
+            raise
+
+        wait = time.perf_counter() - start
+        entry["acquisitions"] += 1
+        entry["total_wait"] += wait
+        entry["max_wait"] = max(entry["max_wait"], wait)
+        return entry
+
+    def release(self, entry):
+        """ Returns a borrowed connection to the pool
+        :param entry: the pool entry returned by acquire
+        """
+        entry["last_used"] = time.monotonic()
+        self.free.put(entry)
+
+    def check(self, entry):
+        """ Makes sure the connection of an entry is open, alive and using the pool database
+        :param entry: the pool entry
+        """
+        if entry["connection"] is None:
+            entry["connection"] = self.connect()
+            entry["database"] = self.database
+            entry["session"] = dict(self.session)
+        elif time.monotonic() - entry["last_used"] > self.health_check_interval:
+            try:
+                entry["connection"].ping(reconnect=False)
+            except pymysql.err.Error:
+                self.reconnect(entry)
+
+        if entry["database"] != self.database:
+            entry["connection"].select_db(self.database)
+            entry["database"] = self.database
+        if entry["session"] != self.session:
+            with entry["connection"].cursor() as cursor:
+                cursor.execute(self.session_command())
+            entry["session"] = dict(self.session)
+
+    def reconnect(self, entry):
+        """ Replaces the connection of an entry with a new one
+        :param entry: the pool entry
+        """
+        try:
+            entry["connection"].close()
+        except pymysql.err.Error:
+            pass
+        entry["connection"] = self.connect()
+        entry["database"] = self.database
+        entry["session"] = dict(self.session)
+        entry["reconnects"] += 1
+
+    @contextmanager
+    def borrow(self):
+        """ Context manager borrowing a connection from the pool
+            If the block fails, the transaction of the connection is rolled back, so the next borrower
+            does not inherit it. A connection which cannot be rolled back is closed, and reopened when needed.
+        """
+        entry = self.acquire()
+        try:
+            yield entry
+        except Exception:
+            try:
+                entry["connection"].rollback()
+            except Exception:
+                try:
+                    entry["connection"].close()
+                except Exception:
+                    pass
+                entry["connection"] = None
+            raise
+        finally:
+            self.release(entry)
+
+    def create_database(self, *, database):
+        """ Create a database and use it for all the connections in the pool
+        :param database: the name of the new database
+        """
+        self.query(f"""
+            CREATE DATABASE IF NOT EXISTS `{database}` 
+                DEFAULT CHARACTER SET utf8 COLLATE utf8_bin;
+        """)
+        self.database = database
+        print(f"Database {database} created.")
+
+    def query(self, query):
+        """ Perform a query on this databases
+            The query is retried once on a new connection if the server closed the borrowed one
+        :param query: the string of the MariaDB query
+        """
+        with self.borrow() as entry:
+            entry["queries"] += 1
+            try:
+                return timed_query(entry["connection"], query, self.metrics)
+            except (pymysql.err.InterfaceError, pymysql.err.OperationalError) as e:
+                # 2006 is "server has gone away": the query was never run, so it is safe to retry
+                if isinstance(e, pymysql.err.OperationalError) and e.args[0] != 2006:
+                    raise
+                self.reconnect(entry)
+                return timed_query(entry["connection"], query, self.metrics)
+
+    def transaction(self, statements):
+        """ Perform statements in a single transaction on one borrowed connection, rolled back if any of them fails
+        :param statements: the list of strings of the MariaDB statements
+        """
+        with self.borrow() as entry:
+            entry["queries"] += 1
+            timed_transaction(entry["connection"], statements, self.metrics)
+
+    def query_chunks(self, query, *, chunksize=100000):
+        """ Perform a query on this database, yielding the result as DataFrames of at most chunksize rows
+            The connection stays borrowed until the generator is consumed or closed
+        :param query: the string of the MariaDB query
+        :param chunksize: the maximum number of rows in each DataFrame
+        """
+        with self.borrow() as entry:
+            entry["queries"] += 1
+            cursor = entry["connection"].cursor(pymysql.cursors.SSCursor)
+            try:
+                yield from timed_chunks(cursor, query, self.metrics, chunksize=chunksize)
+            finally:
+                cursor.close()
+
+    def stats(self):
+        """ Returns a DataFrame with the usage and the wait times of each connection in the pool """
+        with self.lock:
+            entries = list(self.entries)
+        return pd.DataFrame([{
+            "acquisitions": entry["acquisitions"],
+            "queries": entry["queries"],
+            "reconnects": entry["reconnects"],
+            "total_wait": entry["total_wait"],
+            "mean_wait": entry["total_wait"] / entry["acquisitions"] if entry["acquisitions"] else 0.0,
+            "max_wait": entry["max_wait"],
+        } for entry in entries])
+
+    def close(self):
+        """ Closes all the idle connections in the pool, they are reopened when needed """
+        idle = []
+        while True:
+            try:
+                idle.append(self.free.get_nowait())
+            except queue.Empty:
+                break
+        for entry in idle:
+            if entry["connection"] is not None:
+                entry["connection"].close()
+                entry["connection"] = None
+            self.free.put(entry)
+
+
+def rewrites_tables(method):
+    """ Decorator of the methods of the table classes which rewrite the tables read by get_houses
+        The generation of the tables is bumped after the method, so the results cached before
+        (or while the tables were being rewritten, which may be partial) are known to be stale.
+        The tables known to exist in the database of the connection are then forgotten.
+    :param method: the method, of an object with a connection
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            bump_generation(self.connection)
+            forget_tables(self.connection)
+    return wrapper
+
+
+def set_session(connection, **variables):
+    """ Sets session variables on a connection, or on all the connections of a ConnectionPool
+    :param connection: the connection
+    :param variables: the values of the variables, as SQL literals
+    """
+    if isinstance(connection, ConnectionPool):
+        connection.set_session(**variables)
+    else:
+        connection.query("SET " + ", ".join(f"{name} = {value}" for name, value in variables.items()) + ";")
 
 
 class PPDataTable:
     """ The pp_data table in the MariaDB database
     :param connection: the connection to the database
+    :param manifest: the file recording the parts already loaded, used to resume an interrupted load
     """
 
-    def __init__(self, connection):
+    def __init__(self, connection, *, manifest="pp_data_manifest.json"):
         self.connection = connection
+        self.manifest = manifest
+        self.manifest_lock = threading.Lock()
 
-    def create_table(self):
-        """ Create the table in the database """
+    # The secondary indices of the table, which can be dropped and rebuilt in bulk around a load
+    secondary_indices = {
+        "pp.postcode": "(postcode)",
+        "pp.date_of_transfer": "(date_of_transfer)",
+        "pp.transaction_unique_identifier": "(transaction_unique_identifier(38))",
+    }
+
+    @rewrites_tables
+    def create_table(self, *, partitioned=False, start_year=1995, end_year=2021):
+        """ Create the table in the database
+        :param partitioned: if true, the table is partitioned by the year of the transfer,
+            so queries on a date range only read the partitions of those years
+        :param start_year: the first year with its own partition
+        :param end_year: the last year with its own partition (later years share a partition)
+        """
+
+        # The table is recreated empty, so no part is loaded anymore
+        if self.manifest and os.path.exists(self.manifest):
+            os.remove(self.manifest)
+
+        partitions = ""
+        if partitioned:
+            partitions = "PARTITION BY RANGE COLUMNS(date_of_transfer) (" + ", ".join(
+                [f"PARTITION p{year} VALUES LESS THAN ('{year + 1}-01-01')" for year in range(start_year, end_year + 1)]
+                + ["PARTITION pmax VALUES LESS THAN (MAXVALUE)"]
+            ) + ")"
+
+        # The derived table is dropped too: the new rows restart from db_id 1, so it could not be refreshed
         return self.connection.query(f"""
+            DROP TABLE IF EXISTS `prices_coordinates`, `prices_coordinates_build`;
             DROP TABLE IF EXISTS `pp_data`;
             CREATE TABLE IF NOT EXISTS `pp_data` (
                 `transaction_unique_identifier` tinytext COLLATE utf8_bin NOT NULL,
@@ -139,45 +696,377 @@ class PPDataTable:
                 `ppd_category_type` varchar(2) COLLATE utf8_bin NOT NULL,
                 `record_status` varchar(2) COLLATE utf8_bin NOT NULL,
                 `db_id` bigint(20) unsigned NOT NULL
-            ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin AUTO_INCREMENT=1;
+            ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin AUTO_INCREMENT=1
+            {partitions};
         """)
 
+    def partitions(self):
+        """ Returns the set of the names of the partitions of the table, empty if it is not partitioned """
+        return set(self.connection.query(f"""
+            SELECT partition_name AS partition_name
+            FROM information_schema.partitions
+            WHERE table_schema = DATABASE() AND table_name = "pp_data" AND partition_name IS NOT NULL
+        """)["partition_name"])
+
+    def is_partitioned(self):
+        """ Returns True if the table is partitioned """
+        return len(self.partitions()) > 0
+
+    def existing_indices(self):
+        """ Returns the set of the names of the secondary indices currently on the table """
+        return set(self.connection.query(f"""
+            SELECT DISTINCT index_name
+            FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = "pp_data"
+        """)["index_name"]) & set(self.secondary_indices)
+
+    @rewrites_tables
     def create_indices(self):
         """ Create the indices for the table """
-        return self.connection.query(f"""
+
+        # The primary key of a partitioned table must include the partitioning column
+        primary_key = "`db_id`, `date_of_transfer`" if self.is_partitioned() else "`db_id`"
+        self.connection.query(f"""
             ALTER TABLE `pp_data`
-            ADD PRIMARY KEY (`db_id`),
+            ADD PRIMARY KEY ({primary_key}),
             MODIFY `db_id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,AUTO_INCREMENT=1;
-            CREATE INDEX `pp.postcode` USING BTREE
-                ON `pp_data`
-                    (postcode);
-            CREATE INDEX `pp.date_of_transfer` USING BTREE
-                ON `pp_data` 
-                    (date_of_transfer);
         """)
+        return self.create_secondary_indices()
+
+    def create_secondary_indices(self, names=None):
+        """ Create the secondary indices of the table, if they do not exist
+            They are all built by a single ALTER TABLE, so the table is only read once
+        :param names: the names of the indices (by default all of them)
+        """
+        names = self.secondary_indices if names is None else names
+        if not names:
+            return None
+        return self.connection.query("ALTER TABLE `pp_data` " + ",".join(f"""
+            ADD INDEX IF NOT EXISTS `{name}` USING BTREE {self.secondary_indices[name]}
+        """ for name in names) + ";")
 
-    def load_data(self, *, start_year=1995, end_year=2021):
-        """ Load the UK Price Paid data into the table from the gov.uk site """
+    def drop_secondary_indices(self, names=None):
+        """ Drop the secondary indices of the table, if they exist
+        :param names: the names of the indices (by default all of them)
+        """
+        names = self.secondary_indices if names is None else names
+        if not names:
+            return None
+        return self.connection.query("ALTER TABLE `pp_data` " + ",".join(f"""
+            DROP INDEX IF EXISTS `{name}`
+        """ for name in names) + ";")
 
-        for year in range(start_year, end_year + 1):
-            for part in range(1, 3):
-                print(f"\rLoading year {year} part {part}...", end="")
+    def loaded_parts(self):
+        """ Returns the set of files already loaded according to the manifest """
+        if not self.manifest or not os.path.exists(self.manifest):
+            return set()
+        with open(self.manifest) as manifest_file:
+            return set(json.load(manifest_file)["loaded"])
 
-                filename = f"pp-{year}-part{part}.csv"
-                url = f"http://prod.publicdata.landregistry.gov.uk.s3-website-eu-west-1.amazonaws.com/{filename}"
-                request.urlretrieve(url, filename)
+    def checkpoint(self, filename):
+        """ Records in the manifest that a file was loaded
+            The manifest is replaced atomically, so an interrupted run never leaves it corrupted
+        :param filename: the file that was loaded
+        """
+        if not self.manifest:
+            return
+        with self.manifest_lock:
+            loaded = sorted(self.loaded_parts() | {filename})
+            with open(f"{self.manifest}.tmp", "w") as manifest_file:
+                json.dump({"loaded": loaded}, manifest_file)
+            os.replace(f"{self.manifest}.tmp", self.manifest)
+
+    @rewrites_tables
+    def load_data(self, *, start_year=1995, end_year=2021, source=None, connections=None,
+                  download_workers=4, prefetch=4, defer_indices=False):
+        """ Load the UK Price Paid data into the table from the gov.uk site
+            Files are downloaded by a pool of workers while the previous ones are loaded,
+            and each connection loads a different file in parallel.
+            Parts already recorded in the manifest are skipped, so a failed run can be resumed.
+            The prices_coordinates table is refreshed with the new rows, if it exists.
+        :param start_year: the first year loaded
+        :param end_year: the last year loaded
+        :param source: the function (filename, destination) fetching a file (by default from the gov.uk site)
+        :param connections: the connections used to load the files, all using the database (by default this table's)
+        :param download_workers: the number of files downloaded concurrently
+        :param prefetch: the maximum number of files downloaded but not loaded yet (bounds the disk usage)
+        :param defer_indices: if true, the secondary indices are dropped and unique and foreign key checks
+            disabled during the load, then the indices are rebuilt in bulk
+        """
+
+        if source is None:
+            source = url_source(PP_DATA_URL)
+        if connections is None:
+            connections = [self.connection]
+
+        if defer_indices:
+            deferred = self.existing_indices()
+            self.drop_secondary_indices(deferred)
+            for connection in connections:
+                set_session(connection, unique_checks=0, foreign_key_checks=0)
+            try:
+                self.load_files(start_year=start_year, end_year=end_year, source=source, connections=connections,
+                                download_workers=download_workers, prefetch=prefetch)
+            finally:
+                for connection in connections:
+                    set_session(connection, unique_checks=1, foreign_key_checks=1)
+                print("Rebuilding the indices...")
+                self.create_secondary_indices(deferred)
+        else:
+            self.load_files(start_year=start_year, end_year=end_year, source=source, connections=connections,
+                            download_workers=download_workers, prefetch=prefetch)
+
+        if has_table(self.connection, "prices_coordinates"):
+            PricesCoordinatesTable(self.connection).load_data()
+
+    def load_files(self, *, start_year, end_year, source, connections, download_workers, prefetch):
+        """ Load the files of the years in parallel, see load_data """
+
+        loaded = self.loaded_parts()
+        filenames = [f"pp-{year}-part{part}.csv"
+                     for year in range(start_year, end_year + 1)
+                     for part in range(1, 3)]
+        filenames = [filename for filename in filenames if filename not in loaded]
+
+        stop = threading.Event()
+        slots = threading.Semaphore(prefetch)
+        pending = queue.Queue()
+        progress = {"loaded": 0}
+
+        def produce(downloads):
+            """ Internal method submitting the downloads in file order, each once there is space for its file
+                Taking the slots in file order means the next file to load always gets one, so the loaders
+                never wait for a download that waits for a slot.
+            """
+            try:
+                for filename in filenames:
+                    while not slots.acquire(timeout=1):
+                        if stop.is_set():
+                            return
+                    if stop.is_set():
+                        slots.release()
+                        return
+                    pending.put((filename, downloads.submit(source, filename, filename)))
+            finally:
+                for _ in connections:
+                    pending.put(None)
+
+        def load_file(connection, filename, downloaded):
+            """ Internal method loading a downloaded file with a connection and recording it in the manifest """
+            downloaded.result()
+            start = time.perf_counter()
+            connection.query(f"""
+                LOAD DATA LOCAL INFILE '{filename}' INTO TABLE pp_data
+                    FIELDS TERMINATED BY ','
+                    OPTIONALLY ENCLOSED BY '"'
+                    LINES STARTING BY '' TERMINATED BY '\\n';
+            """)
+            seconds = time.perf_counter() - start
+            metrics = getattr(connection, "metrics", None)
+            last = metrics.last() if metrics is not None else None
+
+            # The part is only recorded once committed, so a resumed load never skips rows that were rolled back
+            connection.query("COMMIT;")
+            self.checkpoint(filename)
+
+            rate = ""
+            if last is not None:
+                metrics.record_load(filename, rows=last["rows"], seconds=seconds)
+                rate = f", {last['rows'] / seconds:.0f} rows/s" if seconds else ""
+            progress["loaded"] += 1
+            print(f"\rLoaded {filename} ({progress['loaded']}/{len(filenames)}{rate})...", end="")
+
+        def load(connection):
+            """ Internal method loading the downloaded files, one at a time, with a connection
+                After an error (here or in another loader) the remaining files are only removed.
+            """
+            error = None
+            while True:
+                item = pending.get()
+                if item is None:
+                    break
+                filename, downloaded = item
+                try:
+                    if not stop.is_set():
+                        load_file(connection, filename, downloaded)
+                except BaseException as e:
+                    stop.set()
+                    error = error or e
+                finally:
+                    wait([downloaded])
+                    if os.path.exists(filename):
+                        os.remove(filename)
+                    slots.release()
+            if error is not None:
+                raise error
+
+        with ThreadPoolExecutor(max_workers=download_workers) as downloads:
+            producer = threading.Thread(target=produce, args=(downloads,))
+            producer.start()
+            try:
+                with ThreadPoolExecutor(max_workers=len(connections)) as loaders:
+                    for loader in as_completed([loaders.submit(load, c) for c in connections]):
+                        loader.result()
+            finally:
+                stop.set()
+                producer.join()
+
+        print("")
+
+    @rewrites_tables
+    def reload_year(self, year, *, source=None):
+        """ Reload the data of a single year of a partitioned table, without touching the other years
+            The year is loaded into a separate table that is then swapped with its partition,
+            so queries keep reading the old data until the new one is complete.
+            The prices_coordinates table is kept in sync, if it exists.
+        :param year: the year reloaded
+        :param source: the function (filename, destination) fetching a file (by default from the gov.uk site)
+        """
+
+        if source is None:
+            source = url_source(PP_DATA_URL)
+
+        # The partition is checked before loading anything, EXCHANGE PARTITION would only fail after the load
+        partitions = self.partitions()
+        if not partitions:
+            raise ValueError("Only the years of a partitioned table can be reloaded")
+        if f"p{year}" not in partitions:
+            raise ValueError(f"The table has no partition of its own for {year}, it shares one with other years")
+
+        # The new rows get db_id larger than any existing one
+        next_id = int(self.connection.query("SELECT COALESCE(MAX(db_id), 0) + 1 AS n FROM pp_data")["n"][0])
+        self.connection.query(f"""
+            DROP TABLE IF EXISTS `pp_data_swap`;
+            CREATE TABLE `pp_data_swap` LIKE `pp_data`;
+            ALTER TABLE `pp_data_swap` REMOVE PARTITIONING;
+            ALTER TABLE `pp_data_swap` AUTO_INCREMENT = {next_id};
+        """)
 
+        for part in range(1, 3):
+            print(f"\rLoading year {year} part {part}...", end="")
+            filename = f"pp-{year}-part{part}.csv"
+            source(filename, filename)
+            try:
                 self.connection.query(f"""
-                    LOAD DATA LOCAL INFILE '{filename}' INTO TABLE pp_data
+                    LOAD DATA LOCAL INFILE '{filename}' INTO TABLE pp_data_swap
                         FIELDS TERMINATED BY ','
                         OPTIONALLY ENCLOSED BY '"'
-                        LINES STARTING BY '' TERMINATED BY '\\n';
+                        LINES STARTING BY '' TERMINATED BY '\\n'
+                        (transaction_unique_identifier, price, date_of_transfer, postcode, property_type,
+                         new_build_flag, tenure_type, primary_addressable_object_name,
+                         secondary_addressable_object_name, street, locality, town_city, district, county,
+                         ppd_category_type, record_status);
+                    COMMIT;
                 """)
-
+            finally:
                 os.remove(filename)
+        print("")
+
+        self.connection.query(f"""
+            ALTER TABLE `pp_data` EXCHANGE PARTITION p{year} WITH TABLE `pp_data_swap`;
+            DROP TABLE `pp_data_swap`;
+        """)
+
+        if has_table(self.connection, "prices_coordinates"):
+            self.connection.query(f"""
+                DELETE FROM prices_coordinates
+                WHERE date_of_transfer >= '{year}-01-01' AND date_of_transfer < '{year + 1}-01-01';
+                COMMIT;
+            """)
+            PricesCoordinatesTable(self.connection).load_data()
+
+    @rewrites_tables
+    def apply_update(self, filename="pp-monthly-update-new-version.csv", *, source=None, batch_size=100000):
+        """ Apply a monthly update of the UK Price Paid data, instead of reloading all the data
+            The rows of the update are staged in a table, then applied in batches according to their record_status:
+            A (added) and C (changed) rows replace the ones with the same transaction identifier, if any,
+            and D (deleted) rows are removed. Each batch is a transaction, rolled back if any of its statements
+            fails, and is idempotent, so an update interrupted (or applied twice) can be applied again
+            without duplicating rows.
+            The prices_coordinates table is kept in sync, if it exists.
+        :param filename: the file of the update
+        :param source: the function (filename, destination) fetching the file (by default from the gov.uk site)
+        :param batch_size: the number of rows of the update applied in each transaction
+        """
+
+        if source is None:
+            source = url_source(PP_DATA_URL)
+        columns = """
+            transaction_unique_identifier, price, date_of_transfer, postcode, property_type, new_build_flag,
+            tenure_type, primary_addressable_object_name, secondary_addressable_object_name, street, locality,
+            town_city, district, county, ppd_category_type, record_status
+        """
+
+        source(filename, filename)
+        try:
+            self.connection.query(f"""
+                DROP TABLE IF EXISTS `pp_data_update`;
+                CREATE TABLE `pp_data_update` (
+                    `transaction_unique_identifier` tinytext COLLATE utf8_bin NOT NULL,
+                    `price` int(10) unsigned NOT NULL,
+                    `date_of_transfer` date NOT NULL,
+                    `postcode` varchar(8) COLLATE utf8_bin NOT NULL,
+                    `property_type` varchar(1) COLLATE utf8_bin NOT NULL,
+                    `new_build_flag` varchar(1) COLLATE utf8_bin NOT NULL,
+                    `tenure_type` varchar(1) COLLATE utf8_bin NOT NULL,
+                    `primary_addressable_object_name` tinytext COLLATE utf8_bin NOT NULL,
+                    `secondary_addressable_object_name` tinytext COLLATE utf8_bin NOT NULL,
+                    `street` tinytext COLLATE utf8_bin NOT NULL,
+                    `locality` tinytext COLLATE utf8_bin NOT NULL,
+                    `town_city` tinytext COLLATE utf8_bin NOT NULL,
+                    `district` tinytext COLLATE utf8_bin NOT NULL,
+                    `county` tinytext COLLATE utf8_bin NOT NULL,
+                    `ppd_category_type` varchar(2) COLLATE utf8_bin NOT NULL,
+                    `record_status` varchar(2) COLLATE utf8_bin NOT NULL,
+                    `staging_id` bigint(20) unsigned NOT NULL AUTO_INCREMENT,
+                    PRIMARY KEY (`staging_id`)
+                ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+                LOAD DATA LOCAL INFILE '{filename}' INTO TABLE pp_data_update
+                    FIELDS TERMINATED BY ','
+                    OPTIONALLY ENCLOSED BY '"'
+                    LINES STARTING BY '' TERMINATED BY '\\n'
+                    ({columns});
+                COMMIT;
+            """)
+        finally:
+            os.remove(filename)
+
+        derived = has_table(self.connection, "prices_coordinates")
+        rows = int(self.connection.query("SELECT COALESCE(MAX(staging_id), 0) AS n FROM pp_data_update")["n"][0])
+
+        for start in range(1, rows + 1, batch_size):
+            print(f"\rApplying rows {start} to {min(start + batch_size - 1, rows)} of {rows}...", end="")
+            batch = f"pp_data_update.staging_id BETWEEN {start} AND {start + batch_size - 1}"
+            replaced = f"""
+                JOIN pp_data_update
+                    ON pp_data.transaction_unique_identifier = pp_data_update.transaction_unique_identifier
+                WHERE {batch} AND pp_data_update.record_status IN ('A', 'C', 'D')
+            """
+            derived_delete = f"""
+                DELETE prices_coordinates FROM prices_coordinates
+                JOIN pp_data ON prices_coordinates.db_id = pp_data.db_id
+                {replaced};
+            """
+            self.connection.transaction(([derived_delete] if derived else []) + [
+                f"""
+                    DELETE pp_data FROM pp_data
+                    {replaced};
+                """,
+                f"""
+                    INSERT INTO pp_data ({columns})
+                    SELECT {columns}
+                    FROM pp_data_update
+                    WHERE {batch} AND record_status IN ('A', 'C');
+                """,
+            ])
 
+        self.connection.query("DROP TABLE IF EXISTS `pp_data_update`;")
         print("")
 
+        # The inserted rows have new db_id, so the incremental load of the derived table picks them up
+        if derived:
+            PricesCoordinatesTable(self.connection).load_data()
+
 
 class PostcodeDataTable:
     """ The postcode_data table in the MariaDB database
@@ -187,8 +1076,11 @@ class PostcodeDataTable:
     def __init__(self, connection):
         self.connection = connection
 
+    @rewrites_tables
     def create_table(self):
-        """ Create the table in the database """
+        """ Create the table in the database
+            The prices_coordinates table, if it exists, is kept (and used by get_houses) until load_data rebuilds it
+        """
         return self.connection.query(f"""
             DROP TABLE IF EXISTS `postcode_data`;
             CREATE TABLE IF NOT EXISTS `postcode_data` (
@@ -214,6 +1106,7 @@ class PostcodeDataTable:
             ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
         """)
 
+    @rewrites_tables
     def create_indices(self):
         """ Create the indices for the table """
         return self.connection.query(f"""
@@ -225,14 +1118,50 @@ class PostcodeDataTable:
             CREATE INDEX `po.postcode` USING HASH
                 ON `postcode_data`
                     (postcode);
+            CREATE INDEX `po.postcode_area` USING BTREE
+                ON `postcode_data`
+                    (postcode_area);
+            CREATE INDEX `po.postcode_district` USING BTREE
+                ON `postcode_data`
+                    (postcode_district);
+            CREATE INDEX `po.postcode_sector` USING BTREE
+                ON `postcode_data`
+                    (postcode_sector);
         """)
 
-    def load_data(self):
-        """ Load the ONS Postcode information into the table from GetTheData.com """
+    @rewrites_tables
+    def create_spatial_index(self):
+        """ Create a POINT column with the location of each postcode and an R-tree spatial index on it
+            The column is filled from lattitude and longitude, so it must be created after load_data
+            (MariaDB does not support spatial indices on generated columns)
+        """
+        return self.connection.query(f"""
+            ALTER TABLE `postcode_data`
+            DROP INDEX IF EXISTS `po.location`,
+            DROP COLUMN IF EXISTS `location`;
+            ALTER TABLE `postcode_data`
+            ADD COLUMN `location` POINT;
+            UPDATE `postcode_data`
+            SET `location` = POINT(longitude, lattitude);
+            ALTER TABLE `postcode_data`
+            MODIFY `location` POINT NOT NULL;
+            CREATE SPATIAL INDEX `po.location`
+                ON `postcode_data`
+                    (location);
+        """)
+
+    @rewrites_tables
+    def load_data(self, *, source=None):
+        """ Load the ONS Postcode information into the table from GetTheData.com
+            The prices_coordinates table is rebuilt with the new coordinates, if it exists
+        :param source: the function (filename, destination) fetching the zip file (by default from GetTheData.com)
+        """
+
+        if source is None:
+            source = url_source("https://www.getthedata.com/downloads/")
 
         filename = "open_postcode_geo.csv"
-        url = "https://www.getthedata.com/downloads/open_postcode_geo.csv.zip"
-        request.urlretrieve(url, f"{filename}.zip")
+        source(f"{filename}.zip", f"{filename}.zip")
 
         with ZipFile(f"{filename}.zip", 'r') as zip_file:
             zip_file.extractall()
@@ -246,96 +1175,988 @@ class PostcodeDataTable:
         os.remove(filename)
         os.remove(f"{filename}.zip")
 
+        # The coordinates of all the rows may have changed, so the derived table cannot be refreshed incrementally
+        if has_table(self.connection, "prices_coordinates"):
+            PricesCoordinatesTable(self.connection).rebuild()
 
-def get_houses(connection, *, postcode=None, bbox=None, sold_after=None, sold_before=None):
-    """ Returns a GeoDataFrame containing houses sales data from pp_data
-        The arguments define filters on the data that should be included
-        This filters are applied directly on the database query for better performance
+
+class PricesCoordinatesTable:
+    """ The prices_coordinates table in the MariaDB database
+        A materialized join of pp_data and postcode_data with the columns needed by get_houses,
+        used automatically by get_houses and get_houses_sample when it exists.
+        The table is built as prices_coordinates_build and only renamed when its first load completes,
+        so get_houses never reads it empty or partial.
     :param connection: the connection to the database
-    :param postcode: filter by postcode or its prefix (e.g. "S" matches "S1...", "S2..." but not "SW...", "SE...")
-    :param bbox: filter by the area where the house is located
-    :param sold_after: filter by the date the house was sold
-    :param sold_before: filter by the date the house was sold
     """
 
-    # Convenient in the query if there are no other conditions
-    conditions = ["TRUE"]
-
-    # Postcode filtering assumes that "S" matches "S1...", "S2..." but not "SW...", "SE..."
-    if postcode:
-        if postcode[-1].isdigit():
-            rpostcode = f"'^{postcode}([^[:digit:]]|$)'"
-        else:
-            rpostcode = f"'^{postcode}([^[:alpha:]]|$)'"
-        conditions.append(f"""pp_data.postcode LIKE "{postcode}%" AND pp_data.postcode RLIKE {rpostcode}""")
+    def __init__(self, connection):
+        self.connection = connection
 
-    if bbox:
-        (lat, lon, dist) = bbox
-        conditions.append(f"lattitude > {lat - dist / 2}")
-        conditions.append(f"lattitude < {lat + dist / 2}")
-        conditions.append(f"longitude > {lon - dist / 2}")
-        conditions.append(f"longitude < {lon + dist / 2}")
+    def target(self):
+        """ Returns the name of the table written: the one being built, if any, or else prices_coordinates """
+        if has_table(self.connection, "prices_coordinates_build"):
+            return "prices_coordinates_build"
+        return "prices_coordinates"
 
-    if sold_after:
-        conditions.append(f"date_of_transfer >= \"{sold_after}\"")
+    @rewrites_tables
+    def create_table(self):
+        """ Create the table in the database, get_houses keeps using the previous one until load_data """
+        return self.connection.query(f"""
+            DROP TABLE IF EXISTS `prices_coordinates_build`;
+            CREATE TABLE IF NOT EXISTS `prices_coordinates_build` (
+                `price` int(10) unsigned NOT NULL,
+                `date_of_transfer` date NOT NULL,
+                `postcode` varchar(8) COLLATE utf8_bin NOT NULL,
+                `property_type` varchar(1) COLLATE utf8_bin NOT NULL,
+                `new_build_flag` varchar(1) COLLATE utf8_bin NOT NULL,
+                `tenure_type` varchar(1) COLLATE utf8_bin NOT NULL,
+                `ppd_category_type` varchar(2) COLLATE utf8_bin NOT NULL,
+                `record_status` varchar(2) COLLATE utf8_bin NOT NULL,
+                `status` enum('live','terminated') NOT NULL,
+                `postcode_area` varchar(2) COLLATE utf8_bin NOT NULL,
+                `postcode_district` varchar(4) COLLATE utf8_bin NOT NULL,
+                `postcode_sector` varchar(6) COLLATE utf8_bin NOT NULL,
+                `lattitude` decimal(11,8) NOT NULL,
+                `longitude` decimal(10,8) NOT NULL,
+                `sample_bucket` smallint unsigned NOT NULL,
+                `db_id` bigint(20) unsigned NOT NULL,
+                PRIMARY KEY (`db_id`)
+            ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+        """)
 
-    if sold_before:
-        conditions.append(f"date_of_transfer <= \"{sold_before}\"")
+    @rewrites_tables
+    def create_indices(self):
+        """ Create the indices for the table """
+        table = self.target()
+        return self.connection.query(f"""
+            CREATE INDEX `pc.date_lat_lon` USING BTREE
+                ON `{table}`
+                    (date_of_transfer, lattitude, longitude);
+            CREATE INDEX `pc.district_date` USING BTREE
+                ON `{table}`
+                    (postcode_district, date_of_transfer);
+            CREATE INDEX `pc.postcode` USING BTREE
+                ON `{table}`
+                    (postcode);
+            CREATE INDEX `pc.postcode_area` USING BTREE
+                ON `{table}`
+                    (postcode_area);
+            CREATE INDEX `pc.postcode_sector` USING BTREE
+                ON `{table}`
+                    (postcode_sector);
+            CREATE INDEX `pc.sample_bucket` USING BTREE
+                ON `{table}`
+                    (sample_bucket);
+        """)
 
-    houses = connection.query(f"""
-            SELECT                 
-                price, 
-                date_of_transfer as date,
+    @rewrites_tables
+    def load_data(self):
+        """ Load the rows of pp_data not in the table yet, joined with their postcode_data
+            The rows are identified by the db_id of pp_data, so the table can be refreshed incrementally
+            after new data is loaded in pp_data. A table being built replaces prices_coordinates once loaded.
+        """
+        table = self.target()
+        self.connection.query(f"""
+            INSERT INTO `{table}`
+            SELECT
+                price,
+                date_of_transfer,
+                postcode,
                 property_type,
                 new_build_flag,
                 tenure_type,
-                postcode, 
-                postcode_district as district, 
                 ppd_category_type,
                 record_status,
-                pp_data.db_id,
-                lattitude as lat, 
-                longitude as lon
+                status,
+                postcode_area,
+                postcode_district,
+                postcode_sector,
+                lattitude,
+                longitude,
+                CONV(SUBSTRING(MD5(pp_data.db_id), 1, 8), 16, 10) % {SAMPLE_BUCKETS},
+                pp_data.db_id
             FROM pp_data
             INNER JOIN postcode_data
             USING (postcode)
-            WHERE {" AND ".join(conditions)}
+            WHERE pp_data.db_id > (SELECT COALESCE(MAX(db_id), 0) FROM `{table}`);
+            COMMIT;
         """)
+        if table == "prices_coordinates_build":
+            # The tables are swapped in a single statement, so get_houses never finds prices_coordinates missing
+            renames = "`prices_coordinates_build` TO `prices_coordinates`"
+            if has_table(self.connection, "prices_coordinates"):
+                renames = f"`prices_coordinates` TO `prices_coordinates_old`, {renames}"
+            self.connection.query(f"""
+                DROP TABLE IF EXISTS `prices_coordinates_old`;
+                RENAME TABLE {renames};
+                DROP TABLE IF EXISTS `prices_coordinates_old`;
+            """)
 
-    if len(houses.index) == 0:
-        return geopandas.GeoDataFrame(crs=4326)
-
-    houses["geometry"] = houses[["lon", "lat"]].apply(shapely.geometry.Point, axis=1)
-    return geopandas.GeoDataFrame(houses, crs=4326)
+    def rebuild(self):
+        """ Rebuild the table with its indices from pp_data and postcode_data, e.g. after postcode_data is reloaded
+            get_houses keeps using the previous table until the new one replaces it
+        """
+        self.create_table()
+        self.create_indices()
+        self.load_data()
 
 
-def get_houses_sample(connection, fraction):
-    """ Returns a GeoDataFrame containing houses sales data from pp_data
-        These are limited to the ones required for the task
-        The fraction (or sample) of data returned in the dataframe
-    :param connection: the connection to the database
-    :param fraction: the fraction of data returned in the dataframe
+class DuckDBConnection:
+    """ A connection to an embedded DuckDB database, whose tables are views over local Parquet files
+        It has the same query interface as Connection, so the functions of this module can use it
+        without a MariaDB server. The MariaDB specific syntax they use is translated before running the queries.
+        Requires duckdb.
+    :param database: the DuckDB database file (by default in memory)
     """
 
-    days = lambda d: (d - datetime.strptime("1995-01-01", "%Y-%m-%d").date()).days
+    dialect = "duckdb"
 
-    houses = connection.query(f"""
-        SELECT 
+    def __init__(self, database=":memory:", *, metrics=None):
+        import duckdb
+        self.database = database
+        self.connection = duckdb.connect(database)
+        self.metrics = QueryMetrics() if metrics is None else metrics
+
+    @staticmethod
+    def translate(query):
+        """ Returns the query with the MariaDB syntax used in this module replaced by the DuckDB one
+        :param query: the string of the MariaDB query
+        """
+        query = re.sub(r"(\S+) RLIKE ('[^']*')", r"regexp_matches(\1, \2)", query)
+        query = re.sub(r'"([^"\n]*)"', r"'\1'", query)
+        query = query.replace("`", '"')
+        query = query.replace("DATABASE()", "current_schema()")
+        return query
+
+    def create_database(self, *, database):
+        """ Create a schema and use it, the equivalent of a MariaDB database
+        :param database: the name of the new database
+        """
+        self.connection.execute(f'CREATE SCHEMA IF NOT EXISTS "{database}"')
+        self.connection.execute(f'SET schema = \'{database}\'')
+        print(f"Database {database} created.")
+
+    def query(self, query):
+        """ Perform a query on this databases
+        :param query: the string of the MariaDB query
+        """
+        start = time.perf_counter()
+        cursor = self.connection.execute(self.translate(query))
+        executed = time.perf_counter()
+        result = pd.DataFrame() if cursor.description is None else cursor.df()
+        materialized = time.perf_counter()
+
+        # DuckDB fetches the rows directly into the DataFrame, so there is no separate fetch phase
+        self.metrics.record(query, execute=executed - start, fetch=0.0, materialize=materialized - executed,
+                            rows=len(result.index), size=int(result.memory_usage(index=False, deep=True).sum()))
+        return result
+
+    def query_chunks(self, query, *, chunksize=100000):
+        """ Perform a query on this database, yielding the result as DataFrames of at most chunksize rows
+        :param query: the string of the MariaDB query
+        :param chunksize: the maximum number of rows in each DataFrame
+        """
+        yield from timed_chunks(self.connection, query, self.metrics, chunksize=chunksize,
+                                statement=self.translate(query))
+
+
+class DuckDBPPDataTable:
+    """ The pp_data table of a DuckDBConnection, a view over one Parquet file per downloaded part
+    :param connection: the DuckDBConnection
+    :param directory: the directory of the Parquet files
+    """
+
+    columns = ["transaction_unique_identifier", "price", "date_of_transfer", "postcode", "property_type",
+               "new_build_flag", "tenure_type", "primary_addressable_object_name",
+               "secondary_addressable_object_name", "street", "locality", "town_city", "district", "county",
+               "ppd_category_type", "record_status"]
+
+    def __init__(self, connection, directory="pp_data"):
+        self.connection = connection
+        self.directory = directory
+
+    @rewrites_tables
+    def create_table(self):
+        """ Create the table, removing the Parquet files of any previous one """
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+        self.connection.connection.execute("DROP VIEW IF EXISTS pp_data")
+
+    @rewrites_tables
+    def create_indices(self):
+        """ Nothing to do, the Parquet files keep min/max statistics of their row groups instead of indices """
+
+    @rewrites_tables
+    def load_data(self, *, start_year=1995, end_year=2021, source=None):
+        """ Load the UK Price Paid data into Parquet files from the gov.uk site
+        :param start_year: the first year loaded
+        :param end_year: the last year loaded
+        :param source: the function (filename, destination) fetching a file (by default from the gov.uk site)
+        """
+        if source is None:
+            source = url_source(PP_DATA_URL)
+
+        columns = ", ".join(f"'{column}': 'VARCHAR'" for column in self.columns)
+        for year in range(start_year, end_year + 1):
+            for part in range(1, 3):
+                print(f"\rLoading year {year} part {part}...", end="")
+                filename = f"pp-{year}-part{part}.csv"
+                source(filename, filename)
+                try:
+                    # The db_id are unique across parts, like the auto increment ids of MariaDB
+                    self.connection.connection.execute(f"""
+                        COPY (
+                            SELECT
+                                transaction_unique_identifier,
+                                CAST(price AS INTEGER) AS price,
+                                CAST(CAST(date_of_transfer AS TIMESTAMP) AS DATE) AS date_of_transfer,
+                                {", ".join(self.columns[3:])},
+                                {(year * 10 + part) * 10 ** 7} + ROW_NUMBER() OVER () AS db_id
+                            FROM read_csv('{filename}', header=false, quote='"', columns={{{columns}}})
+                        ) TO '{os.path.join(self.directory, filename.replace(".csv", ".parquet"))}' (FORMAT PARQUET)
+                    """)
+                finally:
+                    os.remove(filename)
+        print("")
+
+        self.connection.connection.execute(f"""
+            CREATE OR REPLACE VIEW pp_data AS
+            SELECT * FROM read_parquet('{os.path.join(self.directory, "*.parquet")}')
+        """)
+
+
+class DuckDBPostcodeDataTable:
+    """ The postcode_data table of a DuckDBConnection, a view over a Parquet file
+    :param connection: the DuckDBConnection
+    :param directory: the directory of the Parquet file
+    """
+
+    columns = ["postcode", "status", "usertype", "easting", "northing", "positional_quality_indicator", "country",
+               "lattitude", "longitude", "postcode_no_space", "postcode_fixed_width_seven",
+               "postcode_fixed_width_eight", "postcode_area", "postcode_district", "postcode_sector", "outcode",
+               "incode"]
+
+    def __init__(self, connection, directory="postcode_data"):
+        self.connection = connection
+        self.directory = directory
+
+    @rewrites_tables
+    def create_table(self):
+        """ Create the table, removing the Parquet file of any previous one """
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+        self.connection.connection.execute("DROP VIEW IF EXISTS postcode_data")
+
+    @rewrites_tables
+    def create_indices(self):
+        """ Nothing to do, the Parquet files keep min/max statistics of their row groups instead of indices """
+
+    @rewrites_tables
+    def load_data(self, *, source=None):
+        """ Load the ONS Postcode information into a Parquet file from GetTheData.com
+        :param source: the function (filename, destination) fetching the zip file (by default from GetTheData.com)
+        """
+        if source is None:
+            source = url_source("https://www.getthedata.com/downloads/")
+
+        filename = "open_postcode_geo.csv"
+        source(f"{filename}.zip", f"{filename}.zip")
+        with ZipFile(f"{filename}.zip", 'r') as zip_file:
+            zip_file.extractall()
+
+        # Like MariaDB, missing numbers become 0 (e.g. the coordinates of non geographic postcodes)
+        columns = ", ".join(f"'{column}': 'VARCHAR'" for column in self.columns)
+        numbers = {"easting", "northing", "positional_quality_indicator", "lattitude", "longitude"}
+        select = ", ".join(f"COALESCE(TRY_CAST({column} AS DOUBLE), 0) AS {column}" if column in numbers
+                           else column for column in self.columns)
+        path = os.path.join(self.directory, "postcode_data.parquet")
+        try:
+            self.connection.connection.execute(f"""
+                COPY (
+                    SELECT {select}, ROW_NUMBER() OVER () AS db_id
+                    FROM read_csv('{filename}', header=false, quote='"', columns={{{columns}}})
+                ) TO '{path}' (FORMAT PARQUET)
+            """)
+        finally:
+            os.remove(filename)
+            os.remove(f"{filename}.zip")
+
+        self.connection.connection.execute(f"""
+            CREATE OR REPLACE VIEW postcode_data AS
+            SELECT * FROM read_parquet('{path}')
+        """)
+
+
+table_presence = weakref.WeakKeyDictionary()
+
+
+def forget_tables(connection):
+    """ Forgets the tables known to exist in the database of a connection,
+        called whenever the tables are rewritten
+    :param connection: the connection to the database
+    """
+    table_presence.pop(connection, None)
+
+
+def table_generation(connection):
+    """ Returns the generation of the tables in the database, a counter bumped whenever they are rewritten
+        It is 0 until the tables are first rewritten, the table storing it is only created then
+        (so reading the generation does not require the permission to create tables)
+    :param connection: the connection to the database
+    """
+    if not has_table(connection, "table_generation"):
+        # Another session may create the table later, so its absence is not remembered
+        table_presence[connection].pop("table_generation")
+        return 0
+    return int(connection.query("SELECT COUNT(*) AS n FROM `table_generation`")["n"][0])
+
+
+def bump_generation(connection):
+    """ Bumps the generation of the tables in the database, see table_generation
+    :param connection: the connection to the database
+    """
+    connection.query("CREATE TABLE IF NOT EXISTS `table_generation` (`rewritten_at` timestamp NOT NULL);")
+    connection.query("INSERT INTO `table_generation` VALUES (CURRENT_TIMESTAMP);")
+    if getattr(connection, "dialect", "mariadb") == "mariadb":
+        connection.query("COMMIT;")
+
+
+def has_table(connection, table):
+    """ Returns True if the table exists in the database, the answer is remembered for each connection
+    :param connection: the connection to the database
+    :param table: the table name
+    """
+    tables = table_presence.setdefault(connection, {})
+    if table not in tables:
+        tables[table] = len(connection.query(f"""
+            SELECT table_name
+            FROM information_schema.tables
+            WHERE table_schema = DATABASE() AND table_name = '{table}'
+        """).index) > 0
+    return tables[table]
+
+
+def has_spatial_index(connection, table):
+    """ Returns True if the table has a spatial index, the answer is remembered for each connection
+    :param connection: the connection to the database
+    :param table: the table name
+    """
+    if getattr(connection, "dialect", "mariadb") != "mariadb":
+        return False
+    tables = table_presence.setdefault(connection, {})
+    if f"{table}.spatial" not in tables:
+        tables[f"{table}.spatial"] = len(connection.query(f"""
+            SELECT index_name
+            FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = "{table}" AND index_type = "SPATIAL"
+        """).index) > 0
+    return tables[f"{table}.spatial"]
+
+
+def normalize_filters(*, postcode=None, bbox=None, sold_after=None, sold_before=None):
+    """ Returns the filters of get_houses in a canonical form, used to identify the cached results
+        The bbox becomes its bounds [min lat, max lat, min lon, max lon] and the dates become ISO strings
+    :param postcode: filter by postcode or its prefix
+    :param bbox: filter by the area where the house is located
+    :param sold_after: filter by the date the house was sold
+    :param sold_before: filter by the date the house was sold
+    """
+    bounds = None
+    if bbox:
+        (lat, lon, dist) = bbox
+        bounds = [round(float(x), 8) for x in (lat - dist / 2, lat + dist / 2, lon - dist / 2, lon + dist / 2)]
+    return {
+        "postcode": postcode or None,
+        "bounds": bounds,
+        "sold_after": pd.Timestamp(str(sold_after)).date().isoformat() if sold_after else None,
+        "sold_before": pd.Timestamp(str(sold_before)).date().isoformat() if sold_before else None,
+    }
+
+
+def filters_contain(outer, inner):
+    """ Returns True if every house matching the normalized filters inner also matches outer
+    :param outer: the normalized filters of the larger set of houses
+    :param inner: the normalized filters of the smaller set of houses
+    """
+    if outer["postcode"] is not None and outer["postcode"] != inner["postcode"]:
+        return False
+    if outer["bounds"] is not None:
+        if inner["bounds"] is None:
+            return False
+        (o_min_lat, o_max_lat, o_min_lon, o_max_lon) = outer["bounds"]
+        (i_min_lat, i_max_lat, i_min_lon, i_max_lon) = inner["bounds"]
+        if i_min_lat < o_min_lat or i_max_lat > o_max_lat or i_min_lon < o_min_lon or i_max_lon > o_max_lon:
+            return False
+    if outer["sold_after"] is not None:
+        if inner["sold_after"] is None or inner["sold_after"] < outer["sold_after"]:
+            return False
+    if outer["sold_before"] is not None:
+        if inner["sold_before"] is None or inner["sold_before"] > outer["sold_before"]:
+            return False
+    return True
+
+
+def filter_houses(houses, filters):
+    """ Applies the normalized filters of get_houses to a GeoDataFrame of houses, with the same semantics as the query
+    :param houses: the GeoDataFrame of houses
+    :param filters: the normalized filters
+    """
+    if len(houses.index) == 0:
+        return houses
+
+    mask = pd.Series(True, index=houses.index)
+
+    postcode = filters["postcode"]
+    if postcode:
+        other = "[^0-9]" if postcode[-1].isdigit() else "[^A-Za-z]"
+        mask &= houses["postcode"].str.match(f"^{re.escape(postcode)}({other}|$)")
+
+    if filters["bounds"]:
+        (min_lat, max_lat, min_lon, max_lon) = filters["bounds"]
+        lat = houses["lat"].astype(float)
+        lon = houses["lon"].astype(float)
+        mask &= (lat > min_lat) & (lat < max_lat) & (lon > min_lon) & (lon < max_lon)
+
+    dates = pd.to_datetime(houses["date"])
+    if filters["sold_after"]:
+        mask &= dates >= pd.Timestamp(filters["sold_after"])
+    if filters["sold_before"]:
+        mask &= dates <= pd.Timestamp(filters["sold_before"])
+
+    if not mask.any():
+        return geopandas.GeoDataFrame(crs=4326)
+    return houses[mask].reset_index(drop=True)
+
+
+class HousesCache:
+    """ A persistent cache of the results of get_houses, stored as GeoParquet files in a local directory
+        Results are identified by their normalized filters, and a request contained in a cached one
+        (e.g. a smaller bbox or date range) is answered by filtering the cached result locally.
+        Each result records the generation of the tables it was read from, results of other generations
+        are removed when found, so a cache reopened after the tables were reloaded is never stale.
+        The least recently used results are evicted when the cache grows beyond max_bytes.
+        Requires pyarrow.
+    :param directory: the directory where the results are stored
+    :param max_bytes: the maximum total size of the stored results
+    """
+
+    def __init__(self, directory="houses_cache", *, max_bytes=2 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def index_path(self):
+        """ Returns the path of the index describing the stored results """
+        return os.path.join(self.directory, "index.json")
+
+    def read_index(self):
+        """ Returns the index, a dict from the key of each result to its filters, size and last access """
+        if not os.path.exists(self.index_path()):
+            return {}
+        with open(self.index_path()) as index_file:
+            return json.load(index_file)
+
+    def write_index(self, index):
+        """ Replaces the index atomically
+        :param index: the new index
+        """
+        with open(f"{self.index_path()}.tmp", "w") as index_file:
+            json.dump(index, index_file)
+        os.replace(f"{self.index_path()}.tmp", self.index_path())
+
+    @staticmethod
+    def key(filters):
+        """ Returns the key identifying the result of the normalized filters
+        :param filters: the normalized filters
+        """
+        return hashlib.sha1(json.dumps(filters, sort_keys=True).encode()).hexdigest()
+
+    def get(self, *, generation=None, **filters):
+        """ Returns the cached GeoDataFrame for the filters of get_houses, or None if it is not cached
+        :param generation: the current generation of the tables (see table_generation)
+        :param filters: the filters of get_houses
+        """
+        filters = normalize_filters(**filters)
+        key = self.key(filters)
+
+        with self.lock:
+            index = self.read_index()
+            stale = [k for k, entry in index.items() if entry.get("generation") != generation]
+            for k in stale:
+                self.remove(k, index.pop(k))
+            if stale:
+                self.write_index(index)
+
+            if key in index:
+                found = key
+            else:
+                # The smallest cached result containing the requested one
+                supersets = [k for k, entry in index.items() if filters_contain(entry["filters"], filters)]
+                if not supersets:
+                    return None
+                found = min(supersets, key=lambda k: index[k]["size"])
+
+            entry = index[found]
+            entry["last_access"] = time.time()
+            self.write_index(index)
+
+            if entry["empty"]:
+                return geopandas.GeoDataFrame(crs=4326)
+            houses = geopandas.read_parquet(os.path.join(self.directory, f"{found}.parquet"))
+
+        if found == key:
+            return houses
+        return filter_houses(houses, filters)
+
+    def put(self, houses, *, generation=None, **filters):
+        """ Stores the GeoDataFrame returned by get_houses for the filters, evicting old results if needed
+        :param houses: the GeoDataFrame of houses
+        :param generation: the generation of the tables the houses were read from (see table_generation)
+        :param filters: the filters of get_houses
+        """
+        filters = normalize_filters(**filters)
+        key = self.key(filters)
+        path = os.path.join(self.directory, f"{key}.parquet")
+
+        with self.lock:
+            empty = len(houses.index) == 0
+            if not empty:
+                houses.to_parquet(path)
+
+            index = self.read_index()
+            index[key] = {
+                "filters": filters,
+                "generation": generation,
+                "empty": empty,
+                "size": 0 if empty else os.path.getsize(path),
+                "last_access": time.time(),
+            }
+
+            total = sum(entry["size"] for entry in index.values())
+            for old in sorted(index, key=lambda k: index[k]["last_access"]):
+                if total <= self.max_bytes:
+                    break
+                total -= index[old]["size"]
+                self.remove(old, index[old])
+                del index[old]
+
+            self.write_index(index)
+
+    def remove(self, key, entry):
+        """ Deletes the file of a stored result
+        :param key: the key of the result
+        :param entry: the index entry of the result
+        """
+        path = os.path.join(self.directory, f"{key}.parquet")
+        if not entry["empty"] and os.path.exists(path):
+            os.remove(path)
+
+    def invalidate(self):
+        """ Removes all the stored results """
+        with self.lock:
+            index = self.read_index()
+            for key, entry in index.items():
+                self.remove(key, entry)
+            self.write_index({})
+
+
+def postcode_condition(postcode, table):
+    """ Returns the query condition selecting the houses with a postcode or its prefix
+        Prefixes that are a whole area, district, sector or postcode become lookups on the indexed column
+        of that level, other prefixes are matched on the postcode itself.
+    :param postcode: the postcode or its prefix (e.g. "S" matches "S1...", "S2..." but not "SW...", "SE...")
+    :param table: the table containing the postcode of the houses
+    """
+    if re.fullmatch(r"[A-Z]{1,2}", postcode):
+        return f"postcode_area = \"{postcode}\""
+    if re.fullmatch(r"[A-Z]{1,2}[0-9][A-Z]", postcode):
+        return f"postcode_district = \"{postcode}\""
+    if re.fullmatch(r"[A-Z]{1,2}[0-9][0-9]?", postcode):
+        # "W1" also matches the districts "W1A", "W1B", ... but not "W10"
+        districts = [postcode] + [f"{postcode}{letter}" for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"]
+        return "postcode_district IN (" + ", ".join(f"\"{d}\"" for d in districts) + ")"
+    if re.fullmatch(r"[A-Z]{1,2}[0-9][0-9A-Z]? [0-9]", postcode):
+        return f"postcode_sector = \"{postcode}\""
+    if re.fullmatch(r"[A-Z]{1,2}[0-9][0-9A-Z]? [0-9][A-Z]{2}", postcode):
+        return f"{table}.postcode = \"{postcode}\""
+
+    # Postcode filtering assumes that "S" matches "S1...", "S2..." but not "SW...", "SE..."
+    if postcode[-1].isdigit():
+        rpostcode = f"'^{postcode}([^[:digit:]]|$)'"
+    else:
+        rpostcode = f"'^{postcode}([^[:alpha:]]|$)'"
+    return f"""{table}.postcode LIKE "{postcode}%" AND {table}.postcode RLIKE {rpostcode}"""
+
+
+def houses_query(*, postcode=None, bbox=None, sold_after=None, sold_before=None, nearest=None, limit=None,
+                 materialized=False, spatial=False):
+    """ Returns the query selecting houses sales data from pp_data
+        The arguments are the filters of get_houses
+    :param postcode: filter by postcode or its prefix (e.g. "S" matches "S1...", "S2..." but not "SW...", "SE...")
+    :param bbox: filter by the area where the house is located
+    :param sold_after: filter by the date the house was sold
+    :param sold_before: filter by the date the house was sold
+    :param nearest: a (lat, lon) location, the houses are returned by increasing distance from it
+    :param limit: the maximum number of houses returned
+    :param materialized: if true, the data is read from prices_coordinates instead of joining the tables
+    :param spatial: if true, the bbox filter uses the spatial index of postcode_data (ignored if materialized)
+    """
+
+    table = "prices_coordinates" if materialized else "pp_data"
+    source = table if materialized else "pp_data INNER JOIN postcode_data USING (postcode)"
+
+    # Convenient in the query if there are no other conditions
+    conditions = ["TRUE"]
+
+    if postcode:
+        conditions.append(postcode_condition(postcode, table))
+
+    if bbox:
+        (lat, lon, dist) = bbox
+        if spatial and not materialized:
+            (min_lat, max_lat, min_lon, max_lon) = (lat - dist / 2, lat + dist / 2, lon - dist / 2, lon + dist / 2)
+            polygon = (f"POLYGON(({min_lon} {min_lat}, {max_lon} {min_lat}, {max_lon} {max_lat}, "
+                       f"{min_lon} {max_lat}, {min_lon} {min_lat}))")
+            conditions.append(f"MBRContains(ST_GeomFromText('{polygon}'), location)")
+        conditions.append(f"lattitude > {lat - dist / 2}")
+        conditions.append(f"lattitude < {lat + dist / 2}")
+        conditions.append(f"longitude > {lon - dist / 2}")
+        conditions.append(f"longitude < {lon + dist / 2}")
+
+    if sold_after:
+        conditions.append(f"date_of_transfer >= \"{sold_after}\"")
+
+    if sold_before:
+        conditions.append(f"date_of_transfer <= \"{sold_before}\"")
+
+    distance = ""
+    order = ""
+    if nearest:
+        (lat, lon) = nearest
+        distance = f", SQRT(POW(lattitude - {lat}, 2) + POW(longitude - {lon}, 2)) as distance"
+        order = "ORDER BY distance"
+
+    return f"""
+            SELECT                 
+                price, 
+                date_of_transfer as date,
+                property_type,
+                new_build_flag,
+                tenure_type,
+                postcode, 
+                postcode_district as district, 
+                ppd_category_type,
+                record_status,
+                {table}.db_id,
+                lattitude as lat, 
+                longitude as lon
+                {distance}
+            FROM {source}
+            WHERE {" AND ".join(conditions)}
+            {order}
+            {f"LIMIT {int(limit)}" if limit else ""}
+        """
+
+
+# The columns of the query results with few distinct values, stored as categoricals
+CATEGORICAL_COLUMNS = ["property_type", "new_build_flag", "tenure_type", "district", "ppd_category_type",
+                       "record_status"]
+
+
+def compact_dtypes(df):
+    """ Converts the columns of a query result to compact dtypes and returns it
+        Coordinates become floats (instead of Decimal objects), dates datetime64,
+        integers the narrowest type holding them and enumerations categoricals
+    :param df: the DataFrame returned by the query
+    """
+    for column in ["lat", "lon"]:
+        if column in df.columns:
+            df[column] = df[column].astype("float64")
+    for column in ["price", "db_id"]:
+        if column in df.columns:
+            df[column] = pd.to_numeric(df[column], downcast="integer")
+    if "date" in df.columns:
+        df["date"] = pd.to_datetime(df["date"])
+    for column in CATEGORICAL_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype("category")
+    return df
+
+
+def points_geometry(df):
+    """ Returns the array of points of the lon and lat columns, built in a single vectorized step
+    :param df: the DataFrame with lon and lat columns
+    """
+    return geopandas.points_from_xy(df["lon"].astype("float64"), df["lat"].astype("float64"))
+
+
+def houses_to_geodataframe(houses):
+    """ Returns a GeoDataFrame of houses from the result of houses_query
+    :param houses: the DataFrame returned by the query
+    """
+    if len(houses.index) == 0:
+        return geopandas.GeoDataFrame(crs=4326)
+
+    houses = compact_dtypes(houses)
+    return geopandas.GeoDataFrame(houses, geometry=points_geometry(houses), crs=4326)
+
+
+def get_houses(connection, *, postcode=None, bbox=None, sold_after=None, sold_before=None, cache=None):
+    """ Returns a GeoDataFrame containing houses sales data from pp_data
+        The arguments define filters on the data that should be included
+        This filters are applied directly on the database query for better performance
+    :param connection: the connection to the database
+    :param postcode: filter by postcode or its prefix (e.g. "S" matches "S1...", "S2..." but not "SW...", "SE...")
+    :param bbox: filter by the area where the house is located
+    :param sold_after: filter by the date the house was sold
+    :param sold_before: filter by the date the house was sold
+    :param cache: a HousesCache storing the results, so that repeated requests do not query the database
+    """
+    filters = dict(postcode=postcode, bbox=bbox, sold_after=sold_after, sold_before=sold_before)
+
+    # The generation is read before the query, so a result read during a rewrite is stored with the old one
+    generation = None
+    if cache is not None:
+        generation = table_generation(connection)
+        houses = cache.get(generation=generation, **filters)
+        if houses is not None:
+            return houses
+
+    query = houses_query(**filters, materialized=has_table(connection, "prices_coordinates"),
+                         spatial=has_spatial_index(connection, "postcode_data"))
+    houses = houses_to_geodataframe(connection.query(query))
+
+    if cache is not None:
+        cache.put(houses, generation=generation, **filters)
+    return houses
+
+
+def get_nearest_houses(connection, latitude, longitude, *, k, max_distance=1.0, sold_after=None, sold_before=None):
+    """ Returns a GeoDataFrame containing the k houses sold nearest to a location, with a single query
+        The houses are sorted by their "distance" (in degrees) from the location.
+        The search is bounded by a bbox of side max_distance, so the database can use its indices.
+    :param connection: the connection to the database
+    :param latitude: the latitude of the location
+    :param longitude: the longitude of the location
+    :param k: the number of houses
+    :param max_distance: the side of the bbox around the location containing the houses
+    :param sold_after: filter by the date the house was sold
+    :param sold_before: filter by the date the house was sold
+    """
+    query = houses_query(bbox=(latitude, longitude, max_distance), sold_after=sold_after, sold_before=sold_before,
+                         nearest=(latitude, longitude), limit=k,
+                         materialized=has_table(connection, "prices_coordinates"),
+                         spatial=has_spatial_index(connection, "postcode_data"))
+    return houses_to_geodataframe(connection.query(query))
+
+
+def get_houses_chunks(connection, *, postcode=None, bbox=None, sold_after=None, sold_before=None,
+                      chunksize=100000):
+    """ Yields GeoDataFrames containing houses sales data from pp_data, at most chunksize rows each
+        The filters are the same as get_houses, but the rows are streamed from the database,
+        so the memory used does not depend on the size of the result
+    :param connection: the connection to the database
+    :param postcode: filter by postcode or its prefix (e.g. "S" matches "S1...", "S2..." but not "SW...", "SE...")
+    :param bbox: filter by the area where the house is located
+    :param sold_after: filter by the date the house was sold
+    :param sold_before: filter by the date the house was sold
+    :param chunksize: the maximum number of rows in each GeoDataFrame
+    """
+    query = houses_query(postcode=postcode, bbox=bbox, sold_after=sold_after, sold_before=sold_before,
+                         materialized=has_table(connection, "prices_coordinates"),
+                         spatial=has_spatial_index(connection, "postcode_data"))
+    for houses in connection.query_chunks(query, chunksize=chunksize):
+        yield houses_to_geodataframe(houses)
+
+
+# The file marking a directory written by export_houses (pyarrow ignores the files starting with an underscore)
+EXPORT_MARKER = "_houses_export"
+
+
+def export_houses(connection, directory, *, postcode=None, bbox=None, sold_after=None, sold_before=None,
+                  chunksize=500000):
+    """ Exports houses sales data to a Parquet dataset partitioned by year and postcode area
+        The data is streamed from the database, so any region can be exported with bounded memory.
+        The dataset can be read with read_houses on machines without access to the database.
+        Requires pyarrow.
+    :param connection: the connection to the database
+    :param directory: the directory of the dataset, replaced if it is a previous export (otherwise it must be empty)
+    :param postcode: filter by postcode or its prefix (e.g. "S" matches "S1...", "S2..." but not "SW...", "SE...")
+    :param bbox: filter by the area where the house is located
+    :param sold_after: filter by the date the house was sold
+    :param sold_before: filter by the date the house was sold
+    :param chunksize: the number of rows written at once
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    # Each chunk adds new files to its partitions, so a previous export is replaced rather than written into
+    directory = os.path.abspath(directory)
+    if os.path.exists(directory) and os.listdir(directory) \
+            and not os.path.exists(os.path.join(directory, EXPORT_MARKER)):
+        raise ValueError(f"{directory} is not empty and is not a previous export of houses")
+
+    # The dataset is written next to the directory and moved there at the end, so a failed export leaves it intact
+    parent, name = os.path.split(directory)
+    staging = tempfile.mkdtemp(prefix=f".{name}-", dir=parent)
+    try:
+        rows = 0
+        query = houses_query(postcode=postcode, bbox=bbox, sold_after=sold_after, sold_before=sold_before,
+                             materialized=has_table(connection, "prices_coordinates"))
+        for houses in connection.query_chunks(query, chunksize=chunksize):
+            houses["lat"] = houses["lat"].astype(float)
+            houses["lon"] = houses["lon"].astype(float)
+            houses["year"] = pd.to_datetime(houses["date"]).dt.year
+            houses["area"] = houses["postcode"].str.extract(r"^([A-Z]+)", expand=False).fillna("")
+            pyarrow.parquet.write_to_dataset(pyarrow.Table.from_pandas(houses, preserve_index=False),
+                                             staging, partition_cols=["year", "area"])
+            rows += len(houses.index)
+            print(f"\rExported {rows} houses...", end="")
+        print("")
+        open(os.path.join(staging, EXPORT_MARKER), "w").close()
+
+        previous = None
+        if os.path.exists(directory):
+            previous = tempfile.mkdtemp(prefix=f".{name}-", dir=parent)
+            os.replace(directory, previous)
+        os.replace(staging, directory)
+        if previous is not None:
+            shutil.rmtree(previous)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+
+def read_houses(directory, *, postcode=None, bbox=None, sold_after=None, sold_before=None):
+    """ Returns a GeoDataFrame containing houses sales data from a dataset written by export_houses
+        The filters are the same as get_houses. Only the partitions of the requested years and postcode area
+        are read, and the row groups outside the bbox or the dates are skipped using their statistics.
+        Requires pyarrow.
+    :param directory: the directory of the dataset
+    :param postcode: filter by postcode or its prefix (e.g. "S" matches "S1...", "S2..." but not "SW...", "SE...")
+    :param bbox: filter by the area where the house is located
+    :param sold_after: filter by the date the house was sold
+    :param sold_before: filter by the date the house was sold
+    """
+    import pyarrow.parquet
+
+    filters = normalize_filters(postcode=postcode, bbox=bbox, sold_after=sold_after, sold_before=sold_before)
+
+    pushed = []
+    if filters["postcode"]:
+        pushed.append(("area", "=", re.match(r"[A-Z]*", filters["postcode"]).group(0)))
+    if filters["sold_after"]:
+        pushed.append(("year", ">=", int(filters["sold_after"][:4])))
+        pushed.append(("date", ">=", pd.Timestamp(filters["sold_after"]).date()))
+    if filters["sold_before"]:
+        pushed.append(("year", "<=", int(filters["sold_before"][:4])))
+        pushed.append(("date", "<=", pd.Timestamp(filters["sold_before"]).date()))
+    if filters["bounds"]:
+        (min_lat, max_lat, min_lon, max_lon) = filters["bounds"]
+        pushed += [("lat", ">", min_lat), ("lat", "<", max_lat), ("lon", ">", min_lon), ("lon", "<", max_lon)]
+
+    table = pyarrow.parquet.read_table(directory, filters=pushed or None, memory_map=True)
+    houses = table.to_pandas().drop(columns=["year", "area"])
+
+    # The pushed filters are coarse for the postcode, the exact match is applied here
+    return filter_houses(houses_to_geodataframe(houses), filters)
+
+
+def sample_condition(fraction, seed):
+    """ Returns the query condition selecting a fraction of the sample buckets of prices_coordinates
+        The buckets form a contiguous range (wrapping around) starting at a position chosen by the seed,
+        so the index on sample_bucket reads only the sampled rows
+    :param fraction: the fraction of buckets selected
+    :param seed: the seed choosing the buckets
+    """
+    width = min(SAMPLE_BUCKETS, max(1, round(fraction * SAMPLE_BUCKETS)))
+    start = random.Random(seed).randrange(SAMPLE_BUCKETS) if seed is not None else 0
+    end = start + width
+    if end <= SAMPLE_BUCKETS:
+        return f"sample_bucket >= {start} AND sample_bucket < {end}"
+    return f"(sample_bucket >= {start} OR sample_bucket < {end - SAMPLE_BUCKETS})"
+
+
+def random_number(connection, seed):
+    """ Returns the query expression of a random number in [0, 1) for each row of pp_data
+        DuckDB has no seeded random function, so there a seeded number is a hash of the db_id and the seed
+        (the same seed still returns the same sample)
+    :param connection: the connection to the database
+    :param seed: the seed of the numbers (None for unseeded ones)
+    """
+    if getattr(connection, "dialect", "mariadb") == "mariadb":
+        return "RAND()" if seed is None else f"RAND({int(seed)})"
+    if seed is None:
+        return "random()"
+    return f"(hash(pp_data.db_id, {int(seed)}) / 18446744073709551616.0)"
+
+
+def get_houses_sample(connection, fraction, *, seed=None, stratify=None, per_stratum=None):
+    """ Returns a GeoDataFrame containing houses sales data from pp_data
+        These are limited to the ones required for the task
+        The fraction (or sample) of data returned in the dataframe
+        With prices_coordinates the sample is random and only reads the sampled rows through an index,
+        otherwise it scans all the data (systematically taking one row every 1 / fraction, unless a seed is given).
+    :param connection: the connection to the database
+    :param fraction: the fraction of data returned in the dataframe
+    :param seed: the seed of the random sample, the same seed returns the same sample
+    :param stratify: columns among "district", "property_type" and "year" defining the strata,
+        the sample then has at most per_stratum houses of each stratum (so large strata do not dominate it)
+    :param per_stratum: the maximum number of houses sampled in each stratum, required by stratify
+    """
+    if stratify and not per_stratum:
+        raise ValueError("A stratified sample requires per_stratum")
+
+    if has_table(connection, "prices_coordinates"):
+        source = "prices_coordinates"
+        condition = sample_condition(fraction, seed)
+    else:
+        source = "pp_data INNER JOIN postcode_data USING (postcode)"
+        if seed is None:
+            condition = f"pp_data.db_id % {math.ceil(1 / fraction)} = 0"
+        else:
+            condition = f"{random_number(connection, seed)} < {fraction}"
+
+    select = """
             price, 
             date_of_transfer as date, 
             property_type, 
             postcode_district as district, 
             lattitude as lat, 
-            longitude as lon
-        FROM pp_data
-        INNER JOIN postcode_data
-        USING (postcode)
-        WHERE pp_data.db_id % {math.ceil(1 / fraction)} = 0 AND status = "live"
-    """)
+            longitude as lon"""
+
+    if stratify:
+        strata_columns = {"district": "postcode_district",
+                          "property_type": "property_type",
+                          "year": "YEAR(date_of_transfer)"}
+        strata = ", ".join(strata_columns[column] for column in stratify)
+        if source == "prices_coordinates":
+            order = "sample_bucket, db_id"
+        else:
+            order = random_number(connection, seed)
+        houses = connection.query(f"""
+            SELECT price, date, property_type, district, lat, lon FROM (
+                SELECT {select},
+                    ROW_NUMBER() OVER (PARTITION BY {strata} ORDER BY {order}) AS stratum_rank
+                FROM {source}
+                WHERE {condition} AND status = "live"
+            ) AS sample
+            WHERE stratum_rank <= {int(per_stratum)}
+        """)
+    else:
+        houses = connection.query(f"""
+            SELECT {select}
+            FROM {source}
+            WHERE {condition} AND status = "live"
+        """)
 
-    houses["geometry"] = houses[["lon", "lat"]].apply(shapely.geometry.Point, axis=1)
-    houses["date"] = houses["date"].apply(days)
-    return geopandas.GeoDataFrame(houses, crs=4326)[["price", "date", "property_type", "district", "geometry"]]
+    houses = compact_dtypes(houses)
+    houses["date"] = pd.to_numeric((houses["date"] - pd.Timestamp("1995-01-01")).dt.days, downcast="integer")
+    houses = geopandas.GeoDataFrame(houses, geometry=points_geometry(houses), crs=4326)
+    return houses[["price", "date", "property_type", "district", "geometry"]]
 
 
 def get_districts(connection, geo_only=True):
@@ -353,26 +2174,28 @@ def get_districts(connection, geo_only=True):
         GROUP BY district
     """).set_index("district", drop=True)
     return geopandas.GeoSeries(
-        data=districts[["lon", "lat"]].apply(shapely.geometry.Point, axis=1),
+        data=points_geometry(districts),
         index=districts.index,
         crs=4326
     )
 
 
-def get_pois(*, bbox=None, tags=None):
-    """ Returns points of interest from OpenStreetMap
-        For performance reasons (especially on queries on large geographical areas but few results)
-        it uses the overpass API directly, instead of osmnx
-    :param bbox: filters by the location of the pois (by default the entire UK)
-    :param tags: filters by the tags of the pois
+def pois_bounds(bbox=None):
+    """ Returns the bounds (min lat, min lon, max lat, max lon) of the area searched by get_pois
+    :param bbox: the bbox of get_pois (by default the entire UK)
     """
     if bbox:
         (lat, lon, dist) = bbox
-        (minx, miny, maxx, maxy) = (lat - dist, lon - dist,
-                                    lat + dist, lon + dist)
-    else:
-        (minx, miny, maxx, maxy) = (50.0, -11.0, 63.0, 2.0)
+        return lat - dist, lon - dist, lat + dist, lon + dist
+    return 50.0, -11.0, 63.0, 2.0
+
 
+def pois_query(bounds, tags):
+    """ Returns the Overpass query for the pois with any of the tags within the bounds
+    :param bounds: the bounds (min lat, min lon, max lat, max lon) of the area
+    :param tags: the tags of the pois
+    """
+    (minx, miny, maxx, maxy) = bounds
     query_bbox = f"{minx},{miny},{maxx},{maxy}"
     queries = []
     for t in ["node", "way", "relation"]:
@@ -381,6 +2204,265 @@ def get_pois(*, bbox=None, tags=None):
         query_tag_val = "".join(f"{t}[\"{key}\"]({query_bbox});"
                                 for key, val in tags.items() if val is True)
         queries.append(f"{query_tag_only}{query_tag_val}")
+    return "(" + "".join(queries) + ")"
+
+
+def overpass_api():
+    """ Returns the default Overpass client used by get_pois """
+    return overpass.API(max_retry_count=10, retry_timeout=5)
+
+
+def feature_key(feature):
+    """ Returns a key identifying an OpenStreetMap feature, used to remove duplicates
+        Ids are only unique within nodes, ways and relations, so the geometry type is part of the key
+    :param feature: the GeoJSON feature
+    """
+    geometry = feature.get("geometry") or {}
+    return feature.get("id"), geometry.get("type")
+
+
+def feature_bounds(feature):
+    """ Returns the bounds (min lat, min lon, max lat, max lon) of a GeoJSON feature, or None if it has no geometry
+    :param feature: the GeoJSON feature
+    """
+    if not feature.get("geometry"):
+        return None
+    shape = shapely.geometry.shape(feature["geometry"])
+    if shape.is_empty:
+        return None
+    (minx, miny, maxx, maxy) = shape.bounds
+    return miny, minx, maxy, maxx
+
+
+def bounds_intersect(a, b):
+    """ Returns True if two bounds (min lat, min lon, max lat, max lon) intersect
+    :param a: the first bounds
+    :param b: the second bounds
+    """
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def split_bounds(bounds, max_tile_size):
+    """ Splits bounds into a grid of sub-bounds, none larger than max_tile_size degrees on either side
+    :param bounds: the bounds (min lat, min lon, max lat, max lon)
+    :param max_tile_size: the maximum size in degrees of the sub-bounds
+    """
+    (minx, miny, maxx, maxy) = bounds
+    nx = max(1, math.ceil((maxx - minx) / max_tile_size))
+    ny = max(1, math.ceil((maxy - miny) / max_tile_size))
+    dx = (maxx - minx) / nx
+    dy = (maxy - miny) / ny
+    return [(minx + i * dx, miny + j * dy, minx + (i + 1) * dx, miny + (j + 1) * dy)
+            for i in range(nx) for j in range(ny)]
+
+
+def fetch_pois(api, bounds, tags, *, max_tile_size=2.0, per_tag=False, max_workers=2, retries=2):
+    """ Returns the GeoJSON features of the pois with any of the tags within the bounds
+        Large areas are split into sub-tiles (and optionally per tag) queried concurrently,
+        so each Overpass query stays small and a failing one is retried on its own.
+        Features returned by more than one query are included once.
+        Features without a geometry are dropped: the overpass client returns ways and relations without
+        their nodes, so they cannot be located (nor stored in the tiles of a PoisCache, or used for distances).
+    :param api: the Overpass client
+    :param bounds: the bounds (min lat, min lon, max lat, max lon)
+    :param tags: the tags of the pois
+    :param max_tile_size: the maximum size in degrees of the area of each query
+    :param per_tag: if true, each tag is queried separately
+    :param max_workers: the maximum number of concurrent queries
+    :param retries: the number of times a failed query is retried
+    """
+    tag_groups = [{key: val} for key, val in tags.items()] if per_tag else [tags]
+    queries = [pois_query(tile, group) for tile in split_bounds(bounds, max_tile_size) for group in tag_groups]
+
+    def run(query):
+        """ Internal method running a query, retrying it if it fails """
+        for attempt in range(retries + 1):
+            try:
+                return api.Get(query)["features"]
+            except Exception:
+                if attempt == retries:
+                    raise
+
+    features = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for result in pool.map(run, queries):
+            for feature in result:
+                if feature_bounds(feature) is not None:
+                    features[feature_key(feature)] = feature
+    return list(features.values())
+
+
+class PoisCache:
+    """ A persistent cache of Overpass results, stored per tag and per geographic tile in a local directory
+        A get_pois request is answered from the cached tiles covering its area,
+        and only the missing tiles are fetched from the Overpass API.
+    :param directory: the directory where the tiles are stored
+    :param tile_size: the size in degrees (of latitude and longitude) of the tiles
+    """
+
+    def __init__(self, directory="pois_cache", *, tile_size=0.25):
+        self.directory = directory
+        self.tile_size = tile_size
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def tiles(self, bounds):
+        """ Returns the list of tiles (i, j) covering the bounds
+        :param bounds: the bounds (min lat, min lon, max lat, max lon)
+        """
+        (minx, miny, maxx, maxy) = bounds
+        return [(i, j)
+                for i in range(math.floor(minx / self.tile_size), math.floor(maxx / self.tile_size) + 1)
+                for j in range(math.floor(miny / self.tile_size), math.floor(maxy / self.tile_size) + 1)]
+
+    def tile_bounds(self, tile):
+        """ Returns the bounds (min lat, min lon, max lat, max lon) of a tile
+        :param tile: the tile (i, j)
+        """
+        (i, j) = tile
+        return i * self.tile_size, j * self.tile_size, (i + 1) * self.tile_size, (j + 1) * self.tile_size
+
+    def path(self, key, val, tile):
+        """ Returns the file storing the features of a tag in a tile
+        :param key: the key of the tag
+        :param val: the value of the tag (True matches any value)
+        :param tile: the tile (i, j)
+        """
+        tag = key if val is True else f"{key}={val}"
+        tag_directory = hashlib.sha1(f"{self.tile_size}:{tag}".encode()).hexdigest()
+        return os.path.join(self.directory, tag_directory, f"{tile[0]}_{tile[1]}.json")
+
+    def read(self, key, val, tile):
+        """ Returns the cached features of a tag in a tile, or None if the tile is not cached
+        :param key: the key of the tag
+        :param val: the value of the tag
+        :param tile: the tile (i, j)
+        """
+        path = self.path(key, val, tile)
+        if not os.path.exists(path):
+            return None
+        with open(path) as tile_file:
+            return json.load(tile_file)
+
+    def write(self, key, val, tile, features):
+        """ Stores the features of a tag in a tile
+        :param key: the key of the tag
+        :param val: the value of the tag
+        :param tile: the tile (i, j)
+        :param features: the GeoJSON features in the tile
+        """
+        path = self.path(key, val, tile)
+        with self.lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.tmp", "w") as tile_file:
+                json.dump(features, tile_file)
+            os.replace(f"{path}.tmp", path)
+
+    @staticmethod
+    def rectangles(tiles):
+        """ Groups tiles into rectangles of contiguous tiles, covering the tiles and nothing else
+            Each row of tiles is split into runs of contiguous tiles,
+            then the runs spanning the same columns in consecutive rows are merged.
+            Returns a list with the tiles (i, j) of each rectangle
+        :param tiles: the tiles (i, j)
+        """
+        runs = []
+        for i, j in sorted(set(tiles)):
+            if runs and runs[-1][0] == i and runs[-1][2] == j - 1:
+                runs[-1][2] = j
+            else:
+                runs.append([i, j, j])
+
+        rectangles = []
+        last = {}
+        for i, start, end in runs:
+            rectangle = last.get((start, end))
+            if rectangle is not None and rectangle[1] == i - 1:
+                rectangle[1] = i
+            else:
+                rectangle = [i, i, start, end]
+                last[(start, end)] = rectangle
+                rectangles.append(rectangle)
+        return [[(i, j) for i in range(first_i, last_i + 1) for j in range(first_j, last_j + 1)]
+                for first_i, last_i, first_j, last_j in rectangles]
+
+    def fetch(self, api, key, val, tiles, **options):
+        """ Fetches the features of a tag in the tiles from the Overpass API and stores them
+            The tiles are grouped into rectangles, each fetched with fetch_pois,
+            so the tiles already cached around them are not fetched again
+        :param api: the Overpass client
+        :param key: the key of the tag
+        :param val: the value of the tag
+        :param tiles: the tiles (i, j) to fetch
+        :param options: the options of fetch_pois
+        """
+        for rectangle in self.rectangles(tiles):
+            bounds = [self.tile_bounds(tile) for tile in rectangle]
+            area = (min(b[0] for b in bounds), min(b[1] for b in bounds),
+                    max(b[2] for b in bounds), max(b[3] for b in bounds))
+            features = fetch_pois(api, area, {key: val}, **options)
+
+            # A feature crossing tiles is stored in each of them, duplicates are removed when reading
+            located = [(feature, feature_bounds(feature)) for feature in features]
+            for tile, tile_bounds in zip(rectangle, bounds):
+                self.write(key, val, tile,
+                           [feature for feature, fb in located if bounds_intersect(fb, tile_bounds)])
+
+
+def pois_to_geodataframe(features):
+    """ Returns a GeoDataFrame of GeoJSON features, which is empty (but has a geometry) if there are none
+    :param features: the GeoJSON features
+    """
+    if not features:
+        return geopandas.GeoDataFrame(geometry=[], crs=4326)
+    return geopandas.GeoDataFrame.from_features(features, crs=4326)
+
+
+def get_pois(*, bbox=None, tags=None, cache=None, offline=False, api=None,
+             max_tile_size=2.0, per_tag=False, max_workers=2):
+    """ Returns points of interest from OpenStreetMap
+        For performance reasons (especially on queries on large geographical areas but few results)
+        it uses the overpass API directly, instead of osmnx
+        Only the pois with a geometry are returned, with or without a cache (see fetch_pois)
+    :param bbox: filters by the location of the pois (by default the entire UK)
+    :param tags: filters by the tags of the pois
+    :param cache: a PoisCache storing the results, so that only the tiles not cached yet are fetched
+    :param offline: if true, the pois are only read from the cache and the missing tiles are skipped
+    :param api: the Overpass client, any object with a Get(query) method returning GeoJSON (by default overpass.API)
+    :param max_tile_size: larger areas are split into concurrent queries of at most this size in degrees
+    :param per_tag: if true, each tag is queried separately
+    :param max_workers: the maximum number of concurrent Overpass queries
+    """
+    bounds = pois_bounds(bbox)
+    options = dict(max_tile_size=max_tile_size, per_tag=per_tag, max_workers=max_workers)
+
+    if cache is None:
+        if offline:
+            raise ValueError("The offline mode requires a cache")
+        features = fetch_pois(api or overpass_api(), bounds, tags, **options)
+        return pois_to_geodataframe(features)
+
+    tiles = cache.tiles(bounds)
+    features = {}
+    skipped = 0
+    for key, val in tags.items():
+        if val is not True and type(val) is not str:
+            continue
+
+        cached = {tile: cache.read(key, val, tile) for tile in tiles}
+        missing = [tile for tile, tile_features in cached.items() if tile_features is None]
+        if missing and not offline:
+            cache.fetch(api or overpass_api(), key, val, missing, **options)
+            cached.update({tile: cache.read(key, val, tile) for tile in missing})
+        elif missing:
+            skipped += len(missing)
+
+        for tile_features in cached.values():
+            for feature in tile_features or []:
+                if bounds_intersect(feature_bounds(feature), bounds):
+                    features[feature_key(feature)] = feature
+
+    if skipped:
+        print(f"{skipped} tiles are not in the cache, their pois are not included")
 
-    pois = overpass.API(max_retry_count=10, retry_timeout=5).Get("(" + "".join(queries) + ")")
-    return geopandas.GeoDataFrame.from_features(pois['features'], crs=4326)
+    return pois_to_geodataframe(list(features.values()))
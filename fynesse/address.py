@@ -2,11 +2,41 @@
 
 from . import access
 from . import assess
+import time
+import copy
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
+import scipy.sparse
+import scipy.stats
 import statsmodels.api as sm
 import shapely
 
 
+def category_codes(values, categories):
+    """ Returns the position of each value in the categories, -1 for the values not in them
+    :param values: the values (a Series, categorical or not)
+    :param categories: the list of categories
+    """
+    return pd.Index(categories).get_indexer(values)
+
+
+def one_hot_block(codes, size, *, sparse=False, dtype=float):
+    """ Returns the one hot encodings of category codes, as a numpy array or a scipy sparse matrix
+    :param codes: the codes returned by category_codes, -1 codes are encoded as all zeros
+    :param size: the number of categories
+    :param sparse: if true, the encodings are a CSR matrix
+    :param dtype: the dtype of the encodings
+    """
+    rows = np.flatnonzero(codes >= 0)
+    if sparse:
+        return scipy.sparse.csr_matrix((np.ones(len(rows), dtype=dtype), (rows, codes[rows])),
+                                       shape=(len(codes), size))
+    block = np.zeros((len(codes), size), dtype=dtype)
+    block[rows, codes[rows]] = 1
+    return block
+
+
 def one_hot_encoding(df, column, *, values=None):
     """ Creates a dataframe containing one hot encodings of a column
     :param df: the original dataframe
@@ -15,10 +45,233 @@ def one_hot_encoding(df, column, *, values=None):
     """
     if values is None:
         values = df[column].unique()
-    return pd.DataFrame({f"{column}_is_{val}": (df[column] == val).astype(float) for val in values})
+    return pd.DataFrame(one_hot_block(category_codes(df[column], values), len(values)),
+                        index=df.index, columns=[f"{column}_is_{val}" for val in values])
+
+
+class DesignBuilder:
+    """ A make_design function with a fixed vocabulary of the categorical columns, which are one hot encoded
+        from their category codes. The hash table of each vocabulary is built once and reused to encode
+        the train, test and predict frames, which always get the same columns.
+    :param categorical: a dict from the categorical columns to their values, or to None to take the values
+        of the training data (see fitted)
+    :param numerical: a list of the numerical columns
+    :param features: a dict from the names of derived columns to the functions computing them from a frame,
+        they can be used as categorical or numerical columns (e.g. the year of the date)
+    :param intercept: if true, the design has a constant column
+    :param sparse: if true, the design is a DataFrame of sparse columns, much smaller for categories with many values
+        (statsmodels densifies it when fitting, solvers accepting sparse matrices can use design.sparse.to_coo())
+    :param dtype: the dtype of the design
+    """
+
+    def __init__(self, *, categorical=None, numerical=None, features=None, intercept=True, sparse=False,
+                 dtype=float):
+        self.categorical = dict(categorical or {})
+        self.numerical = list(numerical or [])
+        self.features = dict(features or {})
+        self.intercept = intercept
+        self.sparse = sparse
+        self.dtype = dtype
+        self.vocabularies = {}
+
+    def column(self, df, name):
+        """ Returns a column of the frame, or the derived column computed by the features """
+        if name in self.features:
+            return self.features[name](df)
+        return df[name]
+
+    def fitted(self, df):
+        """ Returns a copy of this builder, with the values of the categorical columns without a vocabulary
+            fixed to the ones in the frame. The models fitting local data use a copy for each training data,
+            so their vocabularies never depend on the order they are fitted in.
+        :param df: the training data
+        """
+        builder = copy.copy(self)
+        builder.categorical = {name: list(pd.Series(self.column(df, name)).dropna().unique()) if values is None
+                               else values for name, values in self.categorical.items()}
+        builder.vocabularies = {}
+        return builder
+
+    def vocabulary(self, name):
+        """ Returns the Index of the values of a categorical column, built once
+        :param name: the column name
+        """
+        if name not in self.vocabularies:
+            values = self.categorical[name]
+            if values is None:
+                raise ValueError(f"The values of \"{name}\" are not fixed, give them or use fitted(training data)")
+            self.vocabularies[name] = pd.Index(values)
+        return self.vocabularies[name]
+
+    def columns(self):
+        """ Returns the names of the columns of the design """
+        names = ["intercept"] if self.intercept else []
+        for name in self.categorical:
+            names += [f"{name}_is_{val}" for val in self.vocabulary(name)]
+        return names + self.numerical
+
+    def encode(self, df, name):
+        """ Returns the block of the design for a column of the frame
+        :param df: the frame
+        :param name: the column name
+        """
+        if name in self.categorical:
+            vocabulary = self.vocabulary(name)
+            return one_hot_block(vocabulary.get_indexer(self.column(df, name)), len(vocabulary),
+                                 sparse=self.sparse, dtype=self.dtype)
+        column = np.asarray(self.column(df, name), dtype=self.dtype).reshape(-1, 1)
+        return scipy.sparse.csr_matrix(column) if self.sparse else column
+
+    def __call__(self, df):
+        """ Returns the design matrix of a frame
+        :param df: the frame
+        """
+        blocks = [self.encode(df, name) for name in [*self.categorical, *self.numerical]]
+        if self.intercept:
+            ones = np.ones((len(df.index), 1), dtype=self.dtype)
+            blocks.insert(0, scipy.sparse.csr_matrix(ones) if self.sparse else ones)
+
+        if self.sparse:
+            matrix = (scipy.sparse.hstack(blocks, format="csr") if blocks
+                      else scipy.sparse.csr_matrix((len(df.index), 0)))
+            return pd.DataFrame.sparse.from_spmatrix(matrix, index=df.index, columns=self.columns())
+        matrix = np.hstack(blocks) if blocks else np.empty((len(df.index), 0), dtype=self.dtype)
+        return pd.DataFrame(matrix, index=df.index, columns=self.columns())
 
 
-def test_model(connection, year, postcode, *, response, family, make_design):
+def design_for(make_design, data):
+    """ Returns the make_design function of a model trained on some data
+        A DesignBuilder takes the vocabularies it does not have from the data, any other function is unchanged.
+    :param make_design: the method creating the design matrix
+    :param data: the training data
+    """
+    if isinstance(make_design, DesignBuilder):
+        return make_design.fitted(data)
+    return make_design
+
+
+class BatchedGLM:
+    """ Fits many small independent GLMs at once, with the IRLS iterations of statsmodels' GLM.fit()
+        vectorized over the models. The models are sorted by their number of rows and padded in batches,
+        so each iteration is a few numpy operations on (models, rows, columns) arrays.
+    :param family: the statsmodels family of the models (e.g. sm.families.Gaussian(sm.families.links.log()))
+    :param maxiter: the maximal number of iterations
+    :param tol: the relative change of the coefficients under which a model has converged
+    :param batch_size: the number of models padded and fitted together
+    """
+
+    def __init__(self, family, *, maxiter=100, tol=1e-8, batch_size=256):
+        self.family = family
+        self.maxiter = maxiter
+        self.tol = tol
+        self.batch_size = batch_size
+
+    def fit(self, designs, responses):
+        """ Fits a model for each design and response, and returns self
+            The results are in params, normalized_cov_params, scale, converged and iterations, one entry per model.
+        :param designs: a list of design matrices with the same columns
+        :param responses: a list with the response of each design
+        """
+        designs = [np.asarray(x, dtype=float) for x in designs]
+        responses = [np.asarray(y, dtype=float) for y in responses]
+        models = len(designs)
+        columns = designs[0].shape[1] if models else 0
+
+        self.params = np.zeros((models, columns))
+        self.normalized_cov_params = np.zeros((models, columns, columns))
+        self.scale = np.ones(models)
+        self.converged = np.zeros(models, dtype=bool)
+        self.iterations = np.zeros(models, dtype=int)
+
+        order = np.argsort([len(y) for y in responses], kind="stable")
+        for start in range(0, models, self.batch_size):
+            batch = order[start:start + self.batch_size]
+            rows = max(len(responses[i]) for i in batch)
+            x = np.zeros((len(batch), rows, columns))
+            y = np.zeros((len(batch), rows))
+            mask = np.zeros((len(batch), rows), dtype=bool)
+            for position, i in enumerate(batch):
+                x[position, :len(responses[i])] = designs[i]
+                y[position, :len(responses[i])] = responses[i]
+                mask[position, :len(responses[i])] = True
+            (self.params[batch], self.normalized_cov_params[batch], self.scale[batch],
+             self.converged[batch], self.iterations[batch]) = self.irls(x, y, mask)
+        return self
+
+    def irls(self, x, y, mask):
+        """ Runs IRLS on a batch of padded models
+        :param x: the (models, rows, columns) designs, zero in the padding
+        :param y: the (models, rows) responses
+        :param mask: the (models, rows) mask of the rows which are not padding
+        """
+        family = self.family
+        count = mask.sum(axis=1)
+        mean = np.where(mask, y, 0).sum(axis=1) / np.maximum(count, 1)
+
+        # The padding keeps the starting values, so the link and the variance are always defined
+        y = np.where(mask, y, mean[:, None])
+        mu = (y + mean[:, None]) / 2
+        eta = family.link(mu)
+
+        params = np.zeros((x.shape[0], x.shape[2]))
+        normalized_cov = np.zeros((x.shape[0], x.shape[2], x.shape[2]))
+        converged = np.zeros(x.shape[0], dtype=bool)
+        iterations = np.zeros(x.shape[0], dtype=int)
+        for _ in range(self.maxiter):
+            weights = np.where(mask, family.weights(mu), 0)
+            z = eta + family.link.deriv(mu) * (y - mu)
+            normalized_cov = np.linalg.pinv(np.einsum("bnp,bn,bnq->bpq", x, weights, x, optimize=True))
+            new_params = np.einsum("bpq,bnq,bn->bp", normalized_cov, x, weights * z, optimize=True)
+
+            eta = np.where(mask, np.einsum("bnp,bp->bn", x, new_params), eta)
+            mu = np.where(mask, family.link.inverse(eta), mu)
+
+            iterations += ~converged
+            converged |= np.all(np.abs(new_params - params) <= self.tol * (1 + np.abs(new_params)), axis=1)
+            params = new_params
+            if converged.all():
+                break
+
+        # Like statsmodels, the scale is 1 for the discrete families and the Pearson chi2 over df_resid otherwise
+        if isinstance(family, (sm.families.Binomial, sm.families.Poisson, sm.families.NegativeBinomial)):
+            scale = np.ones(x.shape[0])
+        else:
+            pearson = np.where(mask, (y - mu) ** 2 / family.variance(mu), 0).sum(axis=1)
+            scale = pearson / np.maximum(count - np.linalg.matrix_rank(x), 1)
+
+        return params, normalized_cov, scale, converged, iterations
+
+    def predict(self, designs, *, alpha=0.1):
+        """ Returns a list with a DataFrame of predictions for each model, with the columns of statsmodels'
+            get_prediction(design).summary_frame(alpha): mean, mean_ci_lower and mean_ci_upper
+        :param designs: a list with the design matrix of the inputs of each model
+        :param alpha: the significance level of the intervals
+        """
+        sizes = [len(x) for x in designs]
+        if not sum(sizes):
+            return [pd.DataFrame(columns=["mean", "mean_ci_lower", "mean_ci_upper"],
+                                 index=getattr(x, "index", None)) for x in designs]
+
+        # All the inputs are predicted at once, each row with the model of its segment
+        segments = np.repeat(np.arange(len(designs)), sizes)
+        x = np.concatenate([np.asarray(x, dtype=float).reshape(size, self.params.shape[1])
+                            for x, size in zip(designs, sizes)])
+        eta = np.einsum("np,np->n", x, self.params[segments])
+        variance = np.einsum("np,npq,nq->n", x, self.normalized_cov_params[segments], x) * self.scale[segments]
+        margin = scipy.stats.norm.ppf(1 - alpha / 2) * np.sqrt(variance)
+
+        inverse = self.family.link.inverse
+        predictions = pd.DataFrame({
+            "mean": inverse(eta),
+            "mean_ci_lower": inverse(eta - margin),
+            "mean_ci_upper": inverse(eta + margin),
+        })
+        bounds = np.cumsum([0] + sizes)
+        return [predictions.iloc[start:end].set_index(getattr(x, "index", pd.RangeIndex(end - start)))
+                for x, start, end in zip(designs, bounds[:-1], bounds[1:])]
+
+
+def test_model(connection, year, postcode, *, response, family, make_design, cache=None):
     """ Tests a design by taking all data from a year in a postcode, 
         training on 80% of it and testing on 20%.
         :param connection: the database connection
@@ -27,18 +280,22 @@ def test_model(connection, year, postcode, *, response, family, make_design):
         :param response: the response column ("price" for this task)
         :param family: the family of the model
         :param make_design: the method creating the design matrix
+        :param cache: an optional access.HousesCache for the houses data
     """
     
     data = access.get_houses(connection, postcode=postcode,
                              sold_after=f"{year-1}-06-01",
-                             sold_before=f"{year+1}-06-01)")
+                             sold_before=f"{year+1}-06-01",
+                             cache=cache)
     print(f"Training on {len(data.index)} samples")
+    # The design is built once, so train and test share the encodings and the columns
+    design = design_for(make_design, data)(data)
     train = data.sample(frac=0.8)
     test = data.drop(train.index)
-    model = sm.GLM(train[response], make_design(train), family=family).fit()
+    model = sm.GLM(train[response], design.loc[train.index], family=family).fit()
 
     actual = test["price"]
-    predicted = model.get_prediction(make_design(test)).summary_frame(alpha=0.1)["mean"]
+    predicted = model.get_prediction(design.loc[test.index]).summary_frame(alpha=0.1)["mean"]
 
     print(model.summary())
 
@@ -48,7 +305,8 @@ def test_model(connection, year, postcode, *, response, family, make_design):
     ))
 
 
-def predict_price(connection, latitude, longitude, year, property_type, threshold=100):
+def predict_price(connection, latitude, longitude, year, property_type, threshold=100, *, family, make_design,
+                  nearest=True):
     """ Predicts the price for a certain house by training the model on houses near in space and time
         :param connection: the database connection
         :param latitude: the latitude of the house
@@ -56,6 +314,10 @@ def predict_price(connection, latitude, longitude, year, property_type, threshol
         :param year: the year of this house
         :param property_type: the type of property
         :param threshold: the minimal amount of houses required for training
+        :param family: the family of the model
+        :param make_design: the method creating the design matrix
+        :param nearest: if true, the threshold nearest houses are fetched with a single query,
+            otherwise the area is grown until it contains enough houses
     """
 
     input = pd.DataFrame.from_dict({
@@ -64,27 +326,149 @@ def predict_price(connection, latitude, longitude, year, property_type, threshol
         "geometry": [shapely.geometry.Point(longitude, latitude)]
     })
 
-    # Search for a distance with at least threshold houses
-    distance = 0.001
-    data = None
-    while distance < 1.0:
-        print(f"Trying distance = {distance}...")
-        data = access.get_houses(connection,
-                                 bbox=(latitude, longitude, distance),
-                                 sold_after=f"{year - 1}-06-01",
-                                 sold_before=f"{year + 1}-06-01")
-
-        if len(data.index) > threshold:
-            break
-        else:
-            distance *= 1.4
+    if nearest:
+        data = access.get_nearest_houses(connection, latitude, longitude, k=threshold,
+                                         sold_after=f"{year - 1}-06-01",
+                                         sold_before=f"{year + 1}-06-01")
+        distance = data["distance"].max() if len(data.index) else None
+        print(f"Training the model with the nearest houses, within distance = {distance}")
+    else:
+        # Search for a distance with at least threshold houses
+        distance = 0.001
+        data = None
+        while distance < 1.0:
+            print(f"Trying distance = {distance}...")
+            data = access.get_houses(connection,
+                                     bbox=(latitude, longitude, distance),
+                                     sold_after=f"{year - 1}-06-01",
+                                     sold_before=f"{year + 1}-06-01")
+
+            if len(data.index) > threshold:
+                break
+            else:
+                distance *= 1.4
+
+        print(f"Training the model with distance = {distance}")
 
-    print(f"Training the model with distance = {distance}")
     if len(data.index) < threshold:
         print(f"Only {len(data.index)} datapoints were found in the area, "
               f"the results may be less accurate")
 
+    make_design = design_for(make_design, data)
     model = sm.GLM(data["price"], make_design(data), family=family).fit()
     print(model.summary())
 
     return model.get_prediction(make_design(input)).summary_frame(alpha=0.1)["mean"]
+
+
+def fit_and_predict(data, inputs, family, make_design, alpha):
+    """ Fits a model on the training data and returns the predictions for the inputs with their intervals
+        A module level function, so it can run in a process pool
+        :param data: the training data
+        :param inputs: the houses to predict
+        :param family: the family of the model
+        :param make_design: the method creating the design matrix
+        :param alpha: the significance level of the intervals
+    """
+    make_design = design_for(make_design, data)
+    model = sm.GLM(data["price"], make_design(data), family=family).fit()
+    summary = model.get_prediction(make_design(inputs)).summary_frame(alpha=alpha)
+    return pd.DataFrame({
+        "price": summary["mean"].to_numpy(),
+        "lower": summary["mean_ci_lower"].to_numpy(),
+        "upper": summary["mean_ci_upper"].to_numpy(),
+    }, index=inputs.index)
+
+
+def fit_and_predict_batch(datas, inputs, family, make_design, alpha):
+    """ Fits a model on each training data and returns the predictions for its inputs with their intervals,
+        like fit_and_predict but fitting all the models at once with a BatchedGLM
+        :param datas: the list of training data
+        :param inputs: the list of houses to predict with each training data
+        :param family: the family of the models
+        :param make_design: the method creating the design matrix
+        :param alpha: the significance level of the intervals
+    """
+    designs = [design_for(make_design, data) for data in datas]
+    train = [pd.DataFrame(design(data)) for design, data in zip(designs, datas)]
+    test = [pd.DataFrame(design(houses)) for design, houses in zip(designs, inputs)]
+
+    # The designs may not have the same columns (e.g. one hot encodings of the values in each frame)
+    columns = list(dict.fromkeys(column for design in train + test for column in design.columns))
+    train = [design.reindex(columns=columns, fill_value=0) for design in train]
+    test = [design.reindex(columns=columns, fill_value=0) for design in test]
+
+    model = BatchedGLM(family).fit(train, [data["price"] for data in datas])
+    return [pd.DataFrame({
+        "price": summary["mean"].to_numpy(),
+        "lower": summary["mean_ci_lower"].to_numpy(),
+        "upper": summary["mean_ci_upper"].to_numpy(),
+    }, index=houses.index) for summary, houses in zip(model.predict(test, alpha=alpha), inputs)]
+
+
+def predict_prices(connection, frame, *, family, make_design, threshold=100, cell_size=0.05, margin=0.02,
+                   alpha=0.1, workers=None, batched=False):
+    """ Predicts the prices of many houses, sharing the data fetched and the models between nearby houses
+        Houses sold in the same year and in the same cell of a grid of side cell_size are predicted together:
+        the training data of the group is fetched once and a single model is fitted for it.
+        :param connection: the database connection
+        :param frame: a DataFrame with columns latitude, longitude, year and property_type
+        :param family: the family of the models
+        :param make_design: the method creating the design matrix (a module level function if workers are used)
+        :param threshold: the minimal amount of houses required for training each model
+        :param cell_size: the side in degrees of the cells grouping the houses
+        :param margin: the distance in degrees around the houses of a group where the training data is taken
+        :param alpha: the significance level of the intervals
+        :param workers: the number of processes fitting the models (by default they are fitted in this process)
+        :param batched: if true, the models are fitted all at once by a BatchedGLM instead of one by one
+            by statsmodels (it cannot be combined with workers)
+    """
+    if batched and workers:
+        raise ValueError("The batched models are fitted in this process, they cannot use workers")
+    start = time.perf_counter()
+
+    inputs = pd.DataFrame({
+        "date": frame["year"].map(lambda year: f"{year}-01-01"),
+        "property_type": frame["property_type"],
+        "geometry": [shapely.geometry.Point(lon, lat) for lat, lon in zip(frame["latitude"], frame["longitude"])],
+    }, index=frame.index)
+    groups = frame.groupby([
+        frame["year"],
+        (frame["latitude"] // cell_size).astype(int),
+        (frame["longitude"] // cell_size).astype(int),
+    ]).groups
+
+    # The training data of each group is fetched sequentially, the connection is not shared between processes
+    tasks = []
+    for (year, _, _), index in groups.items():
+        points = frame.loc[index]
+        (min_lat, max_lat) = (points["latitude"].min() - margin, points["latitude"].max() + margin)
+        (min_lon, max_lon) = (points["longitude"].min() - margin, points["longitude"].max() + margin)
+        (lat, lon) = ((min_lat + max_lat) / 2, (min_lon + max_lon) / 2)
+        window = dict(sold_after=f"{year - 1}-06-01", sold_before=f"{year + 1}-06-01")
+
+        data = access.get_houses(connection, bbox=(lat, lon, max(max_lat - min_lat, max_lon - min_lon)), **window)
+        if len(data.index) < threshold:
+            data = access.get_nearest_houses(connection, lat, lon, k=threshold, **window)
+        tasks.append((data, inputs.loc[index], len(data.index)))
+
+    if batched:
+        results = fit_and_predict_batch([data for data, _, _ in tasks], [group_inputs for _, group_inputs, _ in tasks],
+                                        family, make_design, alpha) if tasks else []
+    elif workers:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(fit_and_predict, data, group_inputs, family, make_design, alpha)
+                       for data, group_inputs, _ in tasks]
+            results = [future.result() for future in futures]
+    else:
+        results = [fit_and_predict(data, group_inputs, family, make_design, alpha)
+                   for data, group_inputs, _ in tasks]
+
+    for result, (_, _, training_size) in zip(results, tasks):
+        result["training_size"] = training_size
+    predictions = pd.concat(results).reindex(frame.index) if results else pd.DataFrame()
+
+    elapsed = time.perf_counter() - start
+    print(f"Predicted {len(frame.index)} prices with {len(tasks)} models in {elapsed:.1f}s "
+          f"({len(frame.index) / max(elapsed, 1e-9):.1f} predictions/s)")
+    return predictions
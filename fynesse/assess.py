@@ -5,7 +5,11 @@ How is the data indexed. Crete visualisation routines to assess the data (e.g. i
 Ensure that date formats are correct and correctly time-zoned.
 """
 
+from . import access
+import numpy as np
 import pandas as pd
+import scipy.spatial
+import shapely.strtree
 import bokeh.io
 import bokeh.plotting
 import bokeh.tile_providers
@@ -24,6 +28,21 @@ def assess_database(connection, database):
     """)
 
 
+def assess_queries(connection):
+    """ Displays the time spent by the queries run on the connection, to quickly identify the slow ones
+        The queries are grouped ignoring their literals, the timings are split into execute, fetch and materialize
+    :param connection: the connection to the database
+    """
+    return connection.metrics.summary()
+
+
+def assess_loads(connection):
+    """ Displays the throughput (rows per second) of each file loaded into the database with the connection
+    :param connection: the connection to the database
+    """
+    return connection.metrics.load_summary()
+
+
 def assess_table(connection, database, table):
     """ Displays some information about the table to quickly identify potential issues
     :param connection: the connection to the database
@@ -39,36 +58,150 @@ def assess_table(connection, database, table):
     """)
 
 
-def assess_dataframe(df, *, enumerations=None, dates=None):
-    """ Displays some information about the dataframe to quickly identify potential issues
-    :param df: the dataframe
-    :param enumerations: a list of strings, the columns that are expected to be enumerations
-    :param dates: a list of strings, the columns that are expected to be strings
-    """
+QUANTILES = [0, 0.01, 0.25, 0.5, 0.75, 0.99, 1]
 
-    if enumerations is None:
-        enumerations = []
-    if dates is None:
-        dates = []
+
+def report_assessment(rows, missing, enumerations, dates, quantiles):
+    """ Displays the checks computed by assess_dataframe and assess_table_data
+    :param rows: the number of rows
+    :param missing: a Series from each column to its number of missing elements
+    :param enumerations: a dict from each enumeration column to a Series from its values to their frequencies
+    :param dates: a dict from each date column to its (min, max)
+    :param quantiles: a dict from each numerical column to a Series from the QUANTILES to their values
+    """
 
     # Check 1: number or rows (to avoid empty dataframes or other construction issues)
-    print(f"The number of rows is: {len(df.index)}.")
+    print(f"The number of rows is: {rows}.")
 
     # Check 2: columns containing NaN (to avoid errors with operations later)
-    is_na = df.isna().any()
-    if is_na.any():
-        cols = " ".join(f"\"{col}\"" for col in df.columns[is_na])
+    missing = missing[missing > 0]
+    if len(missing.index):
+        cols = " ".join(f"\"{col}\" ({count})" for col, count in missing.items())
         print(f"These columns have missing elements (NaN): {cols}.")
     else:
         print(f"No column has missing elements (NaN).")
 
     # Check 3: elements in an enumeration (to avoid issues with elements that should not be in the enumeration)
-    for col in enumerations:
-        print(f"Column \"{col}\" only contains: {df[col].unique()}.")
+    for col, frequencies in enumerations.items():
+        values = ", ".join(f"{value} ({count})" for value, count in frequencies.items())
+        print(f"Column \"{col}\" only contains: {values}.")
 
     # Check 4: dates (to avoid issues with the date format and date range)
-    for col in dates:
-        print(f"Column \"{col}\" contains dates from {df[col].min()} to {df[col].max()}.")
+    for col, (low, high) in dates.items():
+        print(f"Column \"{col}\" contains dates from {low} to {high}.")
+
+    # Check 5: quantiles (to find outliers and wrongly scaled values)
+    for col, values in quantiles.items():
+        values = ", ".join(f"{q:g}: {value}" for q, value in values.items())
+        print(f"Column \"{col}\" has quantiles {values}.")
+
+
+def assess_dataframe(df, *, enumerations=None, dates=None, quantiles=None):
+    """ Displays some information about the dataframe to quickly identify potential issues
+    :param df: the dataframe
+    :param enumerations: a list of strings, the columns that are expected to be enumerations
+    :param dates: a list of strings, the columns that are expected to be strings
+    :param quantiles: a list of strings, the numerical columns whose QUANTILES are displayed
+    """
+
+    if enumerations is None:
+        enumerations = []
+    if dates is None:
+        dates = []
+    if quantiles is None:
+        quantiles = []
+
+    # Each check aggregates all its columns at once (pandas cannot aggregate zero columns)
+    ranges = df[dates].agg(["min", "max"]) if dates else None
+    values = df[quantiles].quantile(QUANTILES) if quantiles else None
+    report_assessment(
+        len(df.index),
+        df.isna().sum(),
+        {col: df[col].value_counts(dropna=False) for col in enumerations},
+        {col: (ranges.at["min", col], ranges.at["max", col]) for col in dates},
+        {col: values[col] for col in quantiles},
+    )
+
+
+def assess_table_data(connection, table, *, enumerations=None, dates=None, quantiles=None, sample=None, seed=None):
+    """ Displays the same information as assess_dataframe about a table, computed by the database
+        with a few aggregate queries, without transferring its rows
+        In the database, missing elements are NULL or empty strings.
+    :param connection: the connection to the database
+    :param table: the table name
+    :param enumerations: a list of strings, the columns that are expected to be enumerations
+    :param dates: a list of strings, the columns that are expected to be dates
+    :param quantiles: a list of strings, the numerical columns whose QUANTILES are displayed
+    :param sample: if given, the fraction of rows assessed, selected with the index on sample_bucket
+        (e.g. of prices_coordinates), or else by db_id modulo 1 / sample, which scans the whole table
+        but still aggregates less rows
+    :param seed: the seed choosing the sample
+    """
+
+    if enumerations is None:
+        enumerations = []
+    if dates is None:
+        dates = []
+    if quantiles is None:
+        quantiles = []
+
+    columns = connection.query(f"""
+        SELECT column_name AS name, data_type AS type
+        FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = "{table}"
+        ORDER BY ordinal_position
+    """)
+
+    condition = "TRUE"
+    if sample is not None:
+        if "sample_bucket" in set(columns["name"]):
+            condition = access.sample_condition(sample, seed)
+        else:
+            step = max(1, round(1 / sample))
+            condition = f"db_id % {step} = {(seed or 0) % step}"
+
+    def is_missing(name, data_type):
+        """ Internal method returning the condition of a missing element in a column """
+        if "char" in data_type.lower() or "text" in data_type.lower():
+            return f"{name} IS NULL OR {name} = \"\""
+        return f"{name} IS NULL"
+
+    # One query for the number of rows, the missing elements and the date ranges
+    aggregates = ["COUNT(*) AS `rows`"]
+    aggregates += [f"SUM(CASE WHEN {is_missing(name, data_type)} THEN 1 ELSE 0 END) AS `missing:{name}`"
+                   for name, data_type in columns[["name", "type"]].itertuples(index=False)]
+    aggregates += [f"MIN({col}) AS `min:{col}`, MAX({col}) AS `max:{col}`" for col in dates]
+    result = connection.query(f"""
+        SELECT {", ".join(aggregates)} FROM {table} WHERE {condition}
+    """).iloc[0]
+
+    # One query for the frequencies of all the enumerations
+    frequencies = pd.DataFrame(columns=["column", "value", "frequency"])
+    if enumerations:
+        frequencies = connection.query(" UNION ALL ".join(f"""
+            SELECT "{col}" AS `column`, CAST({col} AS CHAR) AS value, COUNT(*) AS frequency
+            FROM {table} WHERE {condition}
+            GROUP BY {col}
+        """ for col in enumerations))
+
+    # One query for the quantiles, MariaDB only has them as window functions
+    values = pd.Series(dtype=float)
+    if quantiles:
+        window = "OVER ()" if getattr(connection, "dialect", "mariadb") == "mariadb" else ""
+        values = connection.query(f"""
+            SELECT DISTINCT {", ".join(f"PERCENTILE_CONT({q}) WITHIN GROUP (ORDER BY {col}) {window} AS `{col}:{q}`"
+                                       for col in quantiles for q in QUANTILES)}
+            FROM {table} WHERE {condition}
+        """).iloc[0]
+
+    report_assessment(
+        int(result["rows"]),
+        pd.Series({name: int(result[f"missing:{name}"] or 0) for name in columns["name"]}, dtype=int),
+        {col: frequencies[frequencies["column"] == col].set_index("value")["frequency"]
+            .astype(int).sort_values(ascending=False) for col in enumerations},
+        {col: (result[f"min:{col}"], result[f"max:{col}"]) for col in dates},
+        {col: pd.Series({q: values[f"{col}:{q}"] for q in QUANTILES}) for col in quantiles},
+    )
 
 
 def line_plot(x, y, *, name_x="", name_y="", title=""):
@@ -90,6 +223,87 @@ def line_plot(x, y, *, name_x="", name_y="", title=""):
     return p
 
 
+def bin_indices(values, low, high, bins):
+    """ Returns the bin of each value in a histogram of equal bins between low and high, -1 if it is outside
+        The high value is included in the last bin
+    :param values: the numpy array of values
+    :param low: the lower edge of the first bin
+    :param high: the upper edge of the last bin
+    :param bins: the number of bins
+    """
+    idx = np.full(len(values), -1, dtype=np.int64)
+    with np.errstate(invalid="ignore"):
+        valid = np.isfinite(values) & (values >= low) & (values <= high)
+    if high > low:
+        idx[valid] = np.minimum(np.floor((values[valid] - low) / (high - low) * bins), bins - 1)
+    else:
+        idx[valid] = 0
+    return idx
+
+
+def histogram(h, *, groups=None, bins=10000, value_range=None):
+    """ Returns the bin edges and the counts of the histogram of a series, computed in a single pass
+        With groups, the counts are a DataFrame with the counts of each group in a row
+    :param h: the series
+    :param groups: the grouping of data
+    :param bins: the number of bins
+    :param value_range: the (low, high) range of the bins (by default from the minimum to the maximum of h)
+    """
+    values = np.asarray(h, dtype=float)
+    if value_range is None:
+        value_range = (np.nanmin(values), np.nanmax(values))
+    (low, high) = value_range
+    edges = np.linspace(low, high, bins + 1)
+
+    idx = bin_indices(values, low, high, bins)
+    if groups is None:
+        return edges, np.bincount(idx[idx >= 0], minlength=bins)
+
+    # Each (group, bin) pair is counted once, in the same pass over the data
+    if isinstance(groups, pd.Series):
+        groups = groups.reindex(h.index)
+    codes, labels = pd.factorize(np.asarray(groups), sort=True)
+    counted = (idx >= 0) & (codes >= 0)
+    idx = idx[counted]
+    codes = codes[counted]
+    counts = np.bincount(codes * bins + idx, minlength=len(labels) * bins).reshape(len(labels), bins)
+    return edges, pd.DataFrame(counts, index=labels)
+
+
+class StreamingHistogram:
+    """ A histogram built incrementally, e.g. over the chunks of access.get_houses_chunks
+        The range of the bins must be known in advance, values outside it are ignored
+    :param value_range: the (low, high) range of the bins
+    :param bins: the number of bins
+    """
+
+    def __init__(self, value_range, *, bins=10000):
+        self.low, self.high = value_range
+        self.bins = bins
+        self.edges = np.linspace(self.low, self.high, bins + 1)
+        self.total = np.zeros(bins, dtype=np.int64)
+        self.groups = {}
+
+    def update(self, h, *, groups=None):
+        """ Adds the values of a chunk to the histogram
+        :param h: the series of values in the chunk
+        :param groups: the grouping of the chunk
+        """
+        _, counts = histogram(h, groups=groups, bins=self.bins, value_range=(self.low, self.high))
+        if groups is None:
+            self.total += counts
+        else:
+            for label, row in counts.iterrows():
+                self.groups[label] = self.groups.get(label, 0) + row.to_numpy()
+            self.total += counts.to_numpy().sum(axis=0)
+
+    def counts(self):
+        """ Returns the counts of the histogram, a DataFrame with a row per group if groups were given """
+        if not self.groups:
+            return self.total
+        return pd.DataFrame.from_dict(self.groups, orient="index").sort_index()
+
+
 def hist_plot(h, *, groups=None, name_h="", title="", bins=10000):
     """ The plot of a distribution of a series or group of series
     :param h: the series
@@ -101,18 +315,14 @@ def hist_plot(h, *, groups=None, name_h="", title="", bins=10000):
 
     p = bokeh.plotting.figure(title=title, width=600, height=600)
 
-    ht = ((h - h.min()) / (h.max() - h.min()) * bins).astype(int)
-    x = pd.Series(range(0, bins)) / bins * (h.max() - h.min()) + h.min()
+    edges, counts = histogram(h, groups=groups, bins=bins)
+    x = edges[:-1]
 
     if groups is None:
-        y = pd.Series((ht == i).sum() / bins for i in range(0, bins))
-        p.line(x, y, line_width=2)
+        p.line(x, counts / bins, line_width=2)
     else:
-        idx = 0
-        for (gl, gh) in ht.groupby(groups):
-            gy = pd.Series((gh == i).sum() / bins for i in range(0, bins))
-            p.line(x, gy, line_width=2, color=bokeh.palettes.Category10[10][idx], legend_label=gl)
-            idx += 1
+        for idx, (gl, gy) in enumerate(counts.iterrows()):
+            p.line(x, gy.to_numpy() / bins, line_width=2, color=bokeh.palettes.Category10[10][idx], legend_label=gl)
         p.legend.location = "top_right"
         p.legend.click_policy = "hide"
 
@@ -121,7 +331,58 @@ def hist_plot(h, *, groups=None, name_h="", title="", bins=10000):
     return p
 
 
-def scatter_plot(x, y, *, groups=None, name_x="", name_y="", title="", line_diagonal=False, line_horizontal=False):
+def rasterize(x, y, *, x_range, y_range, width=600, height=600):
+    """ Returns the (height, width) array counting the points in each pixel of an image
+    :param x: the x coordinates
+    :param y: the y coordinates
+    :param x_range: the (low, high) x coordinates of the image
+    :param y_range: the (low, high) y coordinates of the image
+    :param width: the number of pixels on the x-axis
+    :param height: the number of pixels on the y-axis
+    """
+    ix = bin_indices(np.asarray(x, dtype=float), *x_range, width)
+    iy = bin_indices(np.asarray(y, dtype=float), *y_range, height)
+    inside = (ix >= 0) & (iy >= 0)
+    return np.bincount(iy[inside] * width + ix[inside], minlength=width * height).reshape(height, width)
+
+
+def points_range(values):
+    """ Returns the (low, high) range of values, widened if they are all equal
+    :param values: the values
+    """
+    low, high = float(np.nanmin(values)), float(np.nanmax(values))
+    return (low - 0.5, high + 0.5) if low == high else (low, high)
+
+
+def add_aggregate(p, x, y, *, x_range, y_range, color, resolution, legend_label=None):
+    """ Adds to a plot the points rasterized into an image, with the opacity of each pixel growing with its count
+    :param p: the plot
+    :param x: the x coordinates
+    :param y: the y coordinates
+    :param x_range: the (low, high) x coordinates of the image
+    :param y_range: the (low, high) y coordinates of the image
+    :param color: the color of the points, as a hex string
+    :param resolution: the number of pixels on each side of the image
+    :param legend_label: the label of the points in the legend
+    """
+    counts = rasterize(x, y, x_range=x_range, y_range=y_range, width=resolution, height=resolution)
+
+    # Log scale, so isolated points are still visible next to dense areas
+    alpha = np.log1p(counts) / max(np.log1p(counts.max()), 1.0)
+    image = np.zeros((resolution, resolution), dtype=np.uint32)
+    rgba = image.view(dtype=np.uint8).reshape((resolution, resolution, 4))
+    rgba[:, :, 0] = int(color[1:3], 16)
+    rgba[:, :, 1] = int(color[3:5], 16)
+    rgba[:, :, 2] = int(color[5:7], 16)
+    rgba[:, :, 3] = np.where(counts > 0, 64 + 191 * alpha, 0).astype(np.uint8)
+
+    kwargs = {} if legend_label is None else {"legend_label": legend_label}
+    p.image_rgba(image=[image], x=x_range[0], y=y_range[0],
+                 dw=x_range[1] - x_range[0], dh=y_range[1] - y_range[0], **kwargs)
+
+
+def scatter_plot(x, y, *, groups=None, name_x="", name_y="", title="", line_diagonal=False, line_horizontal=False,
+                 aggregate=None, max_points=50000, resolution=600):
     """ The scatter plot of 2D points
     :param x: the x coordinates
     :param y: the y coordinates
@@ -131,15 +392,33 @@ def scatter_plot(x, y, *, groups=None, name_x="", name_y="", title="", line_diag
     :param title: the name of the plot
     :param line_diagonal: if true, plots a line y = x
     :param line_horizontal: if true, plots a line y = 0
+    :param aggregate: if true, the points are rasterized into an image instead of being drawn one by one
+        (by default only when there are more than max_points)
+    :param max_points: the number of points above which they are aggregated
+    :param resolution: the number of pixels on each side of the aggregated image
     """
 
+    if aggregate is None:
+        aggregate = len(x) > max_points
+    if aggregate:
+        x_range, y_range = points_range(x), points_range(y)
+
     p = bokeh.plotting.figure(title=title, width=600, height=600)
     if groups is None:
-        p.circle(x, y, size=2, alpha=0.7)
+        if aggregate:
+            add_aggregate(p, x, y, x_range=x_range, y_range=y_range,
+                          color=bokeh.palettes.Category10[10][0], resolution=resolution)
+        else:
+            p.circle(x, y, size=2, alpha=0.7)
     else:
         idx = 0
         for (gl, gx), (_, gy) in zip(x.groupby(groups), y.groupby(groups)):
-            p.circle(gx, gy, size=2, alpha=0.7, color=bokeh.palettes.Category10[10][idx], legend_label=gl)
+            color = bokeh.palettes.Category10[10][idx]
+            if aggregate:
+                add_aggregate(p, gx, gy, x_range=x_range, y_range=y_range,
+                              color=color, resolution=resolution, legend_label=gl)
+            else:
+                p.circle(gx, gy, size=2, alpha=0.7, color=color, legend_label=gl)
             idx += 1
         p.legend.location = "top_right"
         p.legend.click_policy = "hide"
@@ -155,27 +434,30 @@ def scatter_plot(x, y, *, groups=None, name_x="", name_y="", title="", line_diag
     return p
 
 
-def geo_plot(df, *, labels=None, title=""):
+def geo_plot(df, *, labels=None, title="", aggregate=None, max_points=50000, resolution=600):
     """ The plot of a GeoDataFrame
     :param df: the GeoDataFrame
-    :param labels: the labels for the points
+    :param labels: the labels for the points (not shown when the points are aggregated)
     :param title: the name of the plot
+    :param aggregate: if true, the points are rasterized into an image instead of being drawn one by one
+        (by default only when there are more than max_points)
+    :param max_points: the number of points above which they are aggregated
+    :param resolution: the number of pixels on each side of the aggregated image
     """
 
-    df_t = df.to_crs(3857)
+    # The projection and the centroids are computed once
+    centroids = df.to_crs(3857).geometry.centroid
+    x = centroids.x.to_numpy()
+    y = centroids.y.to_numpy()
 
-    if labels is None:
-        source = bokeh.plotting.ColumnDataSource(data=dict(
-            x=df_t.geometry.centroid.x,
-            y=df_t.geometry.centroid.y,
-        ))
+    if aggregate is None:
+        aggregate = len(x) > max_points
+
+    if labels is None or aggregate:
+        data = dict(x=x, y=y)
         tooltips = None
     else:
-        source = bokeh.plotting.ColumnDataSource(data=dict(
-            x=df_t.geometry.centroid.x,
-            y=df_t.geometry.centroid.y,
-            name=labels,
-        ))
+        data = dict(x=x, y=y, name=labels)
         tooltips = [("name", "@name")]
 
     p = bokeh.plotting.figure(
@@ -184,7 +466,11 @@ def geo_plot(df, *, labels=None, title=""):
         tools="pan,wheel_zoom", title=title)
 
     p.add_tile(bokeh.tile_providers.get_provider(bokeh.tile_providers.CARTODBPOSITRON))
-    p.circle('x', 'y', size=10, alpha=0.7, source=source)
+    if aggregate:
+        add_aggregate(p, x, y, x_range=points_range(x), y_range=points_range(y),
+                      color=bokeh.palettes.Category10[10][0], resolution=resolution)
+    else:
+        p.circle('x', 'y', size=10, alpha=0.7, source=bokeh.plotting.ColumnDataSource(data=data))
 
     return p
 
@@ -207,10 +493,93 @@ def get_bbox_around(df, *, padding=0.1):
     return (miny + maxy) / 2, (minx + maxx) / 2, max(maxx - minx, maxy - miny) + padding
 
 
+def points_coordinates(geometries):
+    """ Returns the (n, 2) array of coordinates of a GeoSeries of points
+    :param geometries: the GeoSeries of points
+    """
+    return np.column_stack([geometries.x.to_numpy(), geometries.y.to_numpy()])
+
+
+def get_nearest(sources, targets, *, k=1, max_distance=None, chunksize=100000):
+    """ Returns a DataFrame with the distance and the index of the k nearest targets of each source
+        Points are matched with a KD-tree, other geometries with an STRtree (k = 1 only),
+        so no sources x targets distance matrix is built. Sources are processed in chunks.
+        With k = 1 the DataFrame is indexed like sources, otherwise by (source, rank).
+        Sources with no target within max_distance have distance inf and target NaN.
+    :param sources: the GeoDataFrame (or GeoSeries) of sources
+    :param targets: the GeoDataFrame (or GeoSeries) of targets
+    :param k: the number of nearest targets
+    :param max_distance: the maximum distance of the targets
+    :param chunksize: the number of sources processed at once
+    """
+    source_geometries = sources.geometry
+    target_geometries = targets.geometry
+    bound = np.inf if max_distance is None else max_distance
+
+    if (source_geometries.geom_type == "Point").all() and (target_geometries.geom_type == "Point").all():
+        tree = scipy.spatial.cKDTree(points_coordinates(target_geometries))
+        coordinates = points_coordinates(source_geometries)
+        distances, positions = [], []
+        for start in range(0, len(coordinates), chunksize):
+            d, i = tree.query(coordinates[start:start + chunksize], k=k, distance_upper_bound=bound)
+            distances.append(np.asarray(d).reshape(-1, k))
+            positions.append(np.asarray(i).reshape(-1, k))
+        distances = np.concatenate(distances) if distances else np.empty((0, k))
+        positions = np.concatenate(positions) if positions else np.empty((0, k), dtype=int)
+    elif k == 1:
+        # The items of the tree are the positions of the targets
+        tree = shapely.strtree.STRtree(list(target_geometries))
+        distances = np.full((len(source_geometries), 1), np.inf)
+        positions = np.full((len(source_geometries), 1), len(target_geometries))
+        for position, geometry in enumerate(source_geometries):
+            nearest = tree.nearest_item(geometry)
+            distance = geometry.distance(target_geometries.iloc[nearest])
+            if distance <= bound:
+                distances[position, 0] = distance
+                positions[position, 0] = nearest
+    else:
+        raise ValueError("k nearest targets (k > 1) are only supported for points")
+
+    # Missing neighbours are reported by the trees with the position len(targets)
+    labels = pd.Series(target_geometries.index).reindex(range(len(target_geometries) + 1))
+    result = pd.DataFrame({
+        "distance": distances.ravel(),
+        "target": labels.to_numpy()[positions.ravel()],
+    })
+    if k == 1:
+        result.index = source_geometries.index
+    else:
+        result.index = pd.MultiIndex.from_product([source_geometries.index, range(k)], names=["source", "rank"])
+    return result
+
+
+def get_within_distance(sources, targets, distance, *, chunksize=100000):
+    """ Returns a DataFrame with the pairs of points (source, target) closer than distance and their distance
+    :param sources: the GeoDataFrame (or GeoSeries) of source points
+    :param targets: the GeoDataFrame (or GeoSeries) of target points
+    :param distance: the maximum distance
+    :param chunksize: the number of sources processed at once
+    """
+    target_tree = scipy.spatial.cKDTree(points_coordinates(targets.geometry))
+    coordinates = points_coordinates(sources.geometry)
+    pairs = []
+    for start in range(0, len(coordinates), chunksize):
+        source_tree = scipy.spatial.cKDTree(coordinates[start:start + chunksize])
+        matrix = source_tree.sparse_distance_matrix(target_tree, distance, output_type="coo_matrix")
+        pairs.append(pd.DataFrame({
+            "source": sources.index[start + matrix.row],
+            "target": targets.index[matrix.col],
+            "distance": matrix.data,
+        }))
+    if not pairs:
+        return pd.DataFrame(columns=["source", "target", "distance"])
+    return pd.concat(pairs, ignore_index=True)
+
+
 def get_distances_from_closest(sources, targets):
     """ Returns a Series of distances between each source and their closest target
         This can be used when approximating the location of the houses to their postcode district
     :param targets: the GeoDataFrame of targets
     :param sources: the GeoDataFrame of sources
     """
-    return sources.geometry.apply(targets.distance).min(axis=1)
+    return get_nearest(sources, targets)["distance"]
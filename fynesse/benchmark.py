@@ -0,0 +1,348 @@
+""" This file contains a generator of synthetic data with the schema of the Price Paid and ONS postcode data,
+and benchmarks of the access, assess and address entry points on it.
+"""
+
+from . import access
+from . import assess
+from . import address
+import os
+import time
+import tracemalloc
+from zipfile import ZipFile
+import numpy as np
+import pandas as pd
+import statsmodels.api as sm
+
+# Some postcode areas with the approximate (lat, lon) of their centre, spread over the UK
+AREAS = {
+    "AB": (57.15, -2.10), "B": (52.48, -1.90), "BS": (51.45, -2.58), "CB": (52.20, 0.12), "CF": (51.48, -3.18),
+    "E": (51.53, -0.03), "EC": (51.52, -0.09), "EH": (55.95, -3.19), "G": (55.86, -4.25), "L": (53.41, -2.98),
+    "LS": (53.80, -1.55), "M": (53.48, -2.24), "N": (51.57, -0.11), "NE": (54.98, -1.61), "NW": (51.55, -0.17),
+    "OX": (51.75, -1.26), "S": (53.38, -1.47), "SE": (51.47, -0.06), "SW": (51.46, -0.16), "W": (51.51, -0.20),
+    "WC": (51.52, -0.12), "YO": (53.96, -1.08), "PL": (50.38, -4.14), "IV": (57.48, -4.22), "TR": (50.26, -5.05),
+}
+
+PROPERTY_TYPES = ["D", "S", "T", "F", "O"]
+LETTERS = np.array(list("ABDEFGHJLNPQRSTUWXYZ"))
+
+
+def generate_postcodes(*, districts_per_area=20, postcodes_per_district=200, seed=0):
+    """ Returns a DataFrame with the columns of the ONS postcode data, for synthetic postcodes
+        Postcodes follow the area / district / sector / unit hierarchy, and are located around their area
+    :param districts_per_area: the number of districts in each area
+    :param postcodes_per_district: the number of postcodes in each district
+    :param seed: the seed of the random generator
+    """
+    rng = np.random.default_rng(seed)
+    frames = []
+    for area, (lat, lon) in AREAS.items():
+        for number in range(1, districts_per_area + 1):
+            outcode = f"{area}{number}"
+            (d_lat, d_lon) = (lat + rng.normal(0, 0.05), lon + rng.normal(0, 0.08))
+            sectors = rng.integers(0, 10, postcodes_per_district).astype(str)
+            units = np.char.add(np.char.add(sectors, rng.choice(LETTERS, postcodes_per_district)),
+                                rng.choice(LETTERS, postcodes_per_district))
+            frames.append(pd.DataFrame({
+                "outcode": outcode,
+                "incode": units,
+                "postcode_area": area,
+                "postcode_district": outcode,
+                "postcode_sector": np.char.add(f"{outcode} ", sectors),
+                "lattitude": d_lat + rng.normal(0, 0.01, postcodes_per_district),
+                "longitude": d_lon + rng.normal(0, 0.015, postcodes_per_district),
+            }))
+    postcodes = pd.concat(frames, ignore_index=True).drop_duplicates(["outcode", "incode"], ignore_index=True)
+
+    n = len(postcodes.index)
+    postcodes["postcode"] = postcodes["outcode"] + " " + postcodes["incode"]
+    postcodes["status"] = np.where(rng.random(n) < 0.9, "live", "terminated")
+    postcodes["usertype"] = np.where(rng.random(n) < 0.95, "small", "large")
+    postcodes["easting"] = ((postcodes["longitude"] + 8) * 70000).round().astype(int)
+    postcodes["northing"] = ((postcodes["lattitude"] - 49) * 111000).round().astype(int)
+    postcodes["positional_quality_indicator"] = 1
+    postcodes["country"] = np.where(postcodes["postcode_area"].isin(["AB", "EH", "G", "IV"]), "Scotland",
+                                    np.where(postcodes["postcode_area"] == "CF", "Wales", "England"))
+    postcodes["postcode_no_space"] = postcodes["outcode"] + postcodes["incode"]
+    postcodes["postcode_fixed_width_seven"] = postcodes["outcode"].str.ljust(4) + postcodes["incode"]
+    postcodes["postcode_fixed_width_eight"] = postcodes["outcode"].str.ljust(4) + " " + postcodes["incode"]
+
+    # Like the real data, a few postcodes are not geographic and have no coordinates
+    non_geographic = rng.random(n) < 0.01
+    postcodes["lattitude"] = postcodes["lattitude"].round(8).astype(str).where(~non_geographic, "")
+    postcodes["longitude"] = postcodes["longitude"].round(8).astype(str).where(~non_geographic, "")
+
+    return postcodes[access.DuckDBPostcodeDataTable.columns]
+
+
+def generate_prices(postcodes, rows, *, start_year=1995, end_year=2021, seed=0):
+    """ Returns a DataFrame with the columns of the Price Paid data, for synthetic sales of the postcodes
+    :param postcodes: the DataFrame returned by generate_postcodes
+    :param rows: the number of sales
+    :param start_year: the first year of the sales
+    :param end_year: the last year of the sales
+    :param seed: the seed of the random generator
+    """
+    rng = np.random.default_rng(seed)
+    chosen = postcodes.iloc[rng.integers(0, len(postcodes.index), rows)]
+    years = rng.integers(start_year, end_year + 1, rows)
+    days = rng.integers(0, 365, rows)
+    dates = pd.to_datetime(years.astype(str), format="%Y") + pd.to_timedelta(days, unit="D")
+    property_types = rng.choice(PROPERTY_TYPES, rows, p=[0.25, 0.28, 0.28, 0.17, 0.02])
+
+    # Prices grow over the years and depend on the property type
+    type_factor = pd.Series({"D": 1.6, "S": 1.0, "T": 0.85, "F": 0.8, "O": 1.2})[property_types].to_numpy()
+    prices = rng.lognormal(np.log(60000) + 0.06 * (years - start_year), 0.5) * type_factor
+
+    return pd.DataFrame({
+        "transaction_unique_identifier": [f"{{{u[:8]}-{u[8:12]}-{u[12:16]}-{u[16:20]}-{u[20:]}}}"
+                                          for u in (f"{x:032X}" for x in rng.integers(0, 2 ** 62, rows))],
+        "price": prices.round().astype(int),
+        "date_of_transfer": dates.strftime("%Y-%m-%d 00:00"),
+        "postcode": chosen["postcode"].to_numpy(),
+        "property_type": property_types,
+        "new_build_flag": np.where(rng.random(rows) < 0.1, "Y", "N"),
+        "tenure_type": np.where(property_types == "F", "L", "F"),
+        "primary_addressable_object_name": rng.integers(1, 200, rows).astype(str),
+        "secondary_addressable_object_name": "",
+        "street": "HIGH STREET",
+        "locality": "",
+        "town_city": chosen["postcode_area"].to_numpy(),
+        "district": chosen["postcode_district"].to_numpy(),
+        "county": chosen["postcode_area"].to_numpy(),
+        "ppd_category_type": np.where(rng.random(rows) < 0.95, "A", "B"),
+        "record_status": "A",
+    })
+
+
+def write_synthetic_data(directory, rows, *, start_year=1995, end_year=2021, seed=0, chunksize=1000000):
+    """ Writes synthetic Price Paid files (pp-{year}-part{part}.csv) and the ONS postcode zip to a directory,
+        in the formats of the real files, so the tables can load them with access.directory_source
+    :param directory: the directory of the files
+    :param rows: the number of sales (from 10k to 30M)
+    :param start_year: the first year of the sales
+    :param end_year: the last year of the sales
+    :param seed: the seed of the random generator
+    :param chunksize: the number of sales generated at once, bounding the memory used
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    postcodes = generate_postcodes(districts_per_area=max(5, min(100, rows // 20000)), seed=seed)
+    postcodes_file = os.path.join(directory, "open_postcode_geo.csv")
+    postcodes.to_csv(postcodes_file, header=False, index=False)
+    with ZipFile(f"{postcodes_file}.zip", "w") as zip_file:
+        zip_file.write(postcodes_file, "open_postcode_geo.csv")
+    os.remove(postcodes_file)
+
+    years = list(range(start_year, end_year + 1))
+    for year in years:
+        for part in range(1, 3):
+            open(os.path.join(directory, f"pp-{year}-part{part}.csv"), "w").close()
+
+    # Each chunk is spread over the files of its years, alternating the parts
+    for start in range(0, rows, chunksize):
+        prices = generate_prices(postcodes, min(chunksize, rows - start), start_year=start_year, end_year=end_year,
+                                 seed=seed + 1 + start // chunksize)
+        prices["part"] = np.arange(len(prices.index)) % 2 + 1
+        for (year, part), sales in prices.groupby([prices["date_of_transfer"].str[:4].astype(int), "part"]):
+            sales.drop(columns="part").to_csv(os.path.join(directory, f"pp-{year}-part{part}.csv"), mode="a",
+                                              header=False, index=False, quoting=1)
+
+
+# A simple design matrix for the price prediction benchmarks: an intercept and the property type
+default_design = address.DesignBuilder(categorical={"property_type": PROPERTY_TYPES})
+
+
+def check_batched_glm(family, *, models=50, min_rows=20, max_rows=300, alpha=0.1, rtol=1e-5, seed=0):
+    """ Checks that a BatchedGLM gives the coefficients and the prediction intervals of statsmodels' GLM,
+        on random price models of different sizes (an intercept, the property type and a numerical column)
+        Returns the largest relative differences, and raises AssertionError if one is larger than rtol.
+    :param family: the statsmodels family of the models (e.g. sm.families.Gaussian(sm.families.links.log()))
+    :param models: the number of models
+    :param min_rows: the minimal number of rows of a model
+    :param max_rows: the maximal number of rows of a model
+    :param alpha: the significance level of the intervals
+    :param rtol: the largest relative difference allowed
+    :param seed: the seed of the random generator
+    """
+    rng = np.random.default_rng(seed)
+    # The first property type is the baseline, with all of them the design would be singular next to the intercept
+    design = address.DesignBuilder(categorical={"property_type": PROPERTY_TYPES[1:]}, numerical=["x"])
+    effects = pd.Series({"D": 0.5, "S": 0.1, "T": 0.0, "F": -0.1, "O": 0.3})
+
+    datas = []
+    for size in rng.integers(min_rows, max_rows + 1, models):
+        data = pd.DataFrame({"property_type": rng.choice(PROPERTY_TYPES, size), "x": rng.normal(0, 1, size)})
+        mean = np.exp(12 + effects[data["property_type"]].to_numpy() + 0.2 * data["x"].to_numpy())
+        data["price"] = mean * rng.lognormal(0, 0.2, size)
+        datas.append(data)
+    inputs = [data.head(5) for data in datas]
+
+    batched = address.BatchedGLM(family).fit([design(data) for data in datas], [data["price"] for data in datas])
+    predictions = batched.predict([design(houses) for houses in inputs], alpha=alpha)
+
+    def difference(actual, expected):
+        """ Internal method returning the largest relative difference between two arrays """
+        return float(np.max(np.abs(np.asarray(actual) - np.asarray(expected)) / np.maximum(np.abs(expected), 1e-12)))
+
+    differences = {"params": 0.0, "mean": 0.0, "mean_ci_lower": 0.0, "mean_ci_upper": 0.0}
+    for data, houses, params, prediction in zip(datas, inputs, batched.params, predictions):
+        model = sm.GLM(data["price"], design(data), family=family).fit()
+        summary = model.get_prediction(design(houses)).summary_frame(alpha=alpha)
+        # Coefficients of categories missing from the data are not identified, only the predictions are compared
+        if np.linalg.matrix_rank(design(data).to_numpy()) == len(params):
+            differences["params"] = max(differences["params"], difference(params, model.params))
+        for column in ["mean", "mean_ci_lower", "mean_ci_upper"]:
+            differences[column] = max(differences[column], difference(prediction[column], summary[column]))
+
+    differences = pd.Series(differences)
+    if (differences > rtol).any():
+        raise AssertionError(f"BatchedGLM differs from statsmodels:\n{differences}")
+    return differences
+
+
+def measure(function, *, repeat=3):
+    """ Returns the result of a function, the fewest seconds it took and the peak of the memory it allocated
+        The runs are timed without tracing the memory, which slows down the allocations a lot,
+        and the peak is measured by a separate traced run.
+    :param function: the function, without arguments
+    :param repeat: the number of timed runs
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, min(times, default=None), peak
+
+
+def run_benchmarks(connection, *, postcode="CB1", bbox=(52.2, 0.12, 0.1), sold_after="2010-01-01",
+                   sold_before="2015-12-31", fraction=0.01, repeat=3):
+    """ Returns a DataFrame with the latency and the peak memory of each access, assess and address entry point
+    :param connection: the connection to a database with the pp_data and postcode_data tables
+    :param postcode: the postcode filter of the get_houses benchmark
+    :param bbox: the bbox filter of the get_houses benchmark
+    :param sold_after: the date filter of the get_houses benchmarks
+    :param sold_before: the date filter of the get_houses benchmarks
+    :param fraction: the fraction of get_houses_sample
+    :param repeat: the number of times each benchmark is run, the fastest time is reported
+    """
+    (lat, lon, _) = bbox
+    window = dict(sold_after=sold_after, sold_before=sold_before)
+    houses = access.get_houses(connection, bbox=bbox, **window)
+    districts = access.get_districts(connection)
+
+    benchmarks = {
+        "access.get_houses(postcode)": lambda: access.get_houses(connection, postcode=postcode, **window),
+        "access.get_houses(bbox)": lambda: access.get_houses(connection, bbox=bbox, **window),
+        "access.get_houses_sample": lambda: access.get_houses_sample(connection, fraction),
+        "access.get_districts": lambda: access.get_districts(connection),
+        "address.predict_price": lambda: address.predict_price(
+            connection, lat, lon, int(sold_after[:4]) + 1, "S",
+            family=sm.families.Gaussian(), make_design=default_design),
+        "assess.hist_plot": lambda: assess.hist_plot(houses["price"]),
+        "assess.scatter_plot": lambda: assess.scatter_plot(houses["lon"], houses["lat"]),
+        "assess.geo_plot": lambda: assess.geo_plot(houses),
+        "assess.get_distances_from_closest": lambda: assess.get_distances_from_closest(houses, districts),
+    }
+
+    results = []
+    for name, benchmark in benchmarks.items():
+        result, seconds, peak = measure(benchmark, repeat=repeat)
+        results.append({
+            "benchmark": name,
+            "rows": len(result.index) if hasattr(result, "index") else None,
+            "seconds": seconds,
+            "peak_bytes": peak,
+        })
+    return pd.DataFrame(results).set_index("benchmark")
+
+
+def benchmark_bbox_queries(connection, latitude, longitude, *, sizes=(0.01, 0.05, 0.2, 1.0), repeat=3):
+    """ Returns a DataFrame comparing the time of bbox queries on the lattitude and longitude columns
+        with the same queries using the spatial index of postcode_data, for bboxes of increasing size
+    :param connection: the connection to the database
+    :param latitude: the latitude of the centre of the bboxes
+    :param longitude: the longitude of the centre of the bboxes
+    :param sizes: the sides of the bboxes
+    :param repeat: the number of times each query is run, the fastest time is reported
+    """
+
+    def timed(query):
+        """ Internal method returning the number of rows and the fastest time of the query """
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rows = len(connection.query(query).index)
+            times.append(time.perf_counter() - start)
+        return rows, min(times)
+
+    results = []
+    for size in sizes:
+        bbox = (latitude, longitude, size)
+        rows, columns_time = timed(access.houses_query(bbox=bbox))
+        _, spatial_time = timed(access.houses_query(bbox=bbox, spatial=True))
+        results.append({"size": size, "rows": rows, "columns_time": columns_time, "spatial_time": spatial_time,
+                        "speedup": columns_time / spatial_time if spatial_time else None})
+    return pd.DataFrame(results)
+
+
+def benchmark_backends(connections, *, postcode="CB2", bbox=(52.2, 0.12, 0.05), sold_after="2015-01-01",
+                       sold_before="2020-12-31", repeat=3):
+    """ Returns a DataFrame comparing the time of get_houses and get_districts workloads on different connections
+        (e.g. a Connection to MariaDB and a DuckDBConnection with the same data)
+    :param connections: a dict from the name of each backend to its connection
+    :param postcode: the postcode filter of the get_houses workload
+    :param bbox: the bbox filter of the get_houses workload
+    :param sold_after: the date filter of the get_houses workloads
+    :param sold_before: the date filter of the get_houses workloads
+    :param repeat: the number of times each workload is run, the fastest time is reported
+    """
+    workloads = {
+        "get_houses(postcode)": lambda c: access.get_houses(c, postcode=postcode, sold_after=sold_after,
+                                                            sold_before=sold_before),
+        "get_houses(bbox)": lambda c: access.get_houses(c, bbox=bbox, sold_after=sold_after,
+                                                        sold_before=sold_before),
+        "get_districts": lambda c: access.get_districts(c),
+    }
+
+    results = []
+    for name, connection in connections.items():
+        for workload, run in workloads.items():
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                rows = len(run(connection).index)
+                times.append(time.perf_counter() - start)
+            results.append({"backend": name, "workload": workload, "rows": rows, "seconds": min(times)})
+    return pd.DataFrame(results).pivot(index="workload", columns="backend", values="seconds")
+
+
+def benchmark_synthetic(rows=10000, *, directory="synthetic_data", seed=0, repeat=3):
+    """ Generates synthetic data, loads it into an embedded DuckDB database and runs the benchmarks on it
+        Requires duckdb.
+    :param rows: the number of sales (from 10k to 30M)
+    :param directory: the directory of the generated files
+    :param seed: the seed of the random generator
+    :param repeat: the number of times each benchmark is run
+    """
+    write_synthetic_data(directory, rows, seed=seed)
+
+    connection = access.DuckDBConnection()
+    source = access.directory_source(directory)
+
+    pp_data = access.DuckDBPPDataTable(connection, os.path.join(directory, "pp_data"))
+    pp_data.create_table()
+    pp_data.load_data(source=source)
+
+    postcode_data = access.DuckDBPostcodeDataTable(connection, os.path.join(directory, "postcode_data"))
+    postcode_data.create_table()
+    postcode_data.load_data(source=source)
+
+    return run_benchmarks(connection, repeat=repeat)
@@ -37,7 +37,10 @@ except FileNotFoundError:
     REQUIRED = []
 
 # What packages are optional?
-EXTRAS = {}
+EXTRAS = {
+    "cache": ["pyarrow"],
+    "duckdb": ["duckdb"],
+}
 
 PACKAGE_DATA = {"fynesse": ["defaults.yml"]}
 